@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import os
+from integrity import BlockHasher
+from errors import AuthError, Throttled, RangeError
+
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+
+
+def wake(loop, future):
+  # called from whichever thread released the budget
+  def done():
+    if not future.done():
+      future.set_result(None)
+  try:
+    loop.call_soon_threadsafe(done)
+  except RuntimeError:
+    # the loop of a finished get() is already closed
+    pass
+
+
+class AsyncTransport:
+  """
+  aiohttp based engine for Download: every range is a coroutine on the
+  get() event loop instead of a thread, max_streams of them at a time.
+  Shares the .part/.manifest handling with the threaded path.
+  """
+  def __init__(self, download, max_streams=100):
+    if aiohttp is None:
+      raise ImportError("transport='aiohttp' needs the aiohttp package")
+    self.download = download
+    self.max_streams = max_streams
+    self.session = None
+    self.semaphore = None
+
+  def expired(self, response):
+    return self.download.is_expired(response.status, response.url, response.headers.get('Content-Type', ''))
+
+  async def reauth(self, generation):
+    # the login itself goes through the requests session, once per expiry
+    await asyncio.get_running_loop().run_in_executor(None, self.download.reauth, generation)
+
+  async def acquire(self, nbytes):
+    # wait for the budget on the loop, ranges blocking executor threads would starve reauth
+    loop = asyncio.get_running_loop()
+    while True:
+      woken = loop.create_future()
+      if self.download.budget.try_acquire(nbytes, functools.partial(wake, loop, woken)):
+        return
+      await woken
+
+  async def get_size(self, url):
+    for attempt in range(2):
+      generation = self.download.auth_generation
+      async with self.session.head(url, headers=self.download.headers, allow_redirects=True) as response:
+        if not self.expired(response):
+          return int(response.headers['Content-Length'])
+      if attempt == 1:
+        raise AuthError("session rejected for %s after re-authenticating" % url)
+      await self.reauth(generation)
+
+  async def write_range(self, url, start, end, fd, manifest, pbar, reauth_limit=3):
+    budget = self.download.budget
+    offset = start
+    # the semaphore is the backpressure: only max_streams ranges hold a socket
+    async with self.semaphore:
+      if budget.limited():
+        await self.acquire(end - start + 1)
+      try:
+        for attempt in range(reauth_limit + 1):
+          generation = self.download.auth_generation
+          headers = {'Range': f'bytes={start}-{end}'}
+          headers.update(self.download.headers)
+          async with self.session.get(url, headers=headers) as response:
+            if response.status in (429, 503):
+              raise Throttled("HTTP %d for range %d-%d" % (response.status, start, end))
+            if not self.expired(response):
+              if response.status != 206:
+                raise RangeError("HTTP %d for range %d-%d" % (response.status, start, end))
+              digest = BlockHasher(start, end, manifest.size)
+              try:
+                async for part in response.content.iter_chunked(65536):
+                  if offset + len(part) > end + 1:
+                    raise RangeError("range %d-%d: server sent more than asked for" % (start, end))
+                  os.pwrite(fd, part, offset)
+                  digest.update(part)
+                  offset += len(part)
+              finally:
+                self.download.count(offset - start)
+              break
+          if attempt == reauth_limit:
+            raise AuthError("session still rejected for range %d-%d after re-authenticating" % (start, end))
+          await self.reauth(generation)
+      finally:
+        if budget.limited():
+          budget.release(end - start + 1)
+    if offset != end + 1:
+      raise RangeError("short range %d-%d: got %d bytes" % (start, end, offset - start))
+    manifest.add(start, end, digest.hexdigest())
+    pbar.update(end - start + 1)
+
+  async def run(self, url, output, chunk_size=1000000):
+    self.semaphore = asyncio.Semaphore(self.max_streams)
+    connector = aiohttp.TCPConnector(limit=self.max_streams)
+    connect, read = self.download.timeout
+    timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+    async with aiohttp.ClientSession(connector=connector, auto_decompress=False, timeout=timeout) as session:
+      self.session = session
+      file_size = await self.get_size(url)
+      fetch = functools.partial(self.write_range, url)
+      await self.download.download_resumable(fetch, output, file_size, chunk_size, self.max_streams)
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from download import Download
+from mock_gportal import MockGPortal
+
+"""
+Throughput benchmark for Download against the local MockGPortal.
+
+    python benchmark.py --size 200 --workers 5 10 20 --chunk-sizes 1 4 --latency 0.05 --error-rate 0.01
+
+Every combination of max_workers and chunk size downloads the same file
+and reports MB/s, p50/p99 range latency and the number of range retries.
+"""
+
+
+def run_trial(server, out_dir, max_workers, chunk_size, transport="requests", adaptive=False):
+    downloader = Download("token", "account", "password", auth_url=server.auth_url, transport=transport,
+                          max_streams=max_workers, adaptive=adaptive, backoff_base=0.1)
+    output = os.path.join(out_dir, "bench_%d_%d.h5" % (max_workers, chunk_size))
+    started = time.time()
+    error = None
+    try:
+        downloader.get(server.url("GC1SG1_BENCH_VNRDQ.h5"), output, max_workers, chunk_size=chunk_size)
+    except Exception as e:
+        error = e
+    elapsed = time.time() - started
+    latencies = np.array(downloader.range_latencies) if len(downloader.range_latencies) else np.array([np.nan])
+    downloader.close()
+    for path in [output, output + ".sum", output + ".part", output + ".manifest"]:
+        if os.path.exists(path):
+            os.remove(path)
+    return {
+        "max_workers": max_workers,
+        "chunk_size": chunk_size,
+        "mb_s": downloader.bytes_downloaded / 1e6 / elapsed,
+        "p50": np.percentile(latencies, 50),
+        "p99": np.percentile(latencies, 99),
+        "retries": downloader.retries,
+        "settings": downloader.settings,
+        "error": error
+    }
+
+
+def run_benchmark(workers, chunk_sizes, transport="requests", adaptive=False, **server_options):
+    results = []
+    with MockGPortal(**server_options) as server, tempfile.TemporaryDirectory() as out_dir:
+        for max_workers in workers:
+            for chunk_size in chunk_sizes:
+                results.append(run_trial(server, out_dir, max_workers, chunk_size, transport, adaptive))
+        stats = dict(server.stats)
+    print("%8s %12s %9s %9s %9s %8s" % ("workers", "chunk_size", "MB/s", "p50 s", "p99 s", "retries"))
+    for r in results:
+        print("%8d %12d %9.2f %9.3f %9.3f %8d%s" % (
+            r["max_workers"], r["chunk_size"], r["mb_s"], r["p50"], r["p99"], r["retries"],
+            "" if r["error"] is None else "  FAILED: %s" % r["error"]))
+        if r["settings"]:
+            print("%8s adaptive settings: %s" % ("", r["settings"]))
+    print("server:", stats)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Download against a local mock G-Portal")
+    parser.add_argument("--size", type=float, default=100, help="file size in MB")
+    parser.add_argument("--workers", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--chunk-sizes", type=float, nargs="+", default=[1], help="range sizes in MB")
+    parser.add_argument("--latency", type=float, default=0., help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="per-connection cap in MB/s")
+    parser.add_argument("--error-rate", type=float, default=0., help="fraction of GETs answered with a 5xx")
+    parser.add_argument("--session-ttl", type=float, default=None, help="seconds before a session expires")
+    parser.add_argument("--transport", default="requests", choices=["requests", "aiohttp"])
+    parser.add_argument("--adaptive", action="store_true")
+    args = parser.parse_args()
+
+    run_benchmark(args.workers, [int(c * 1e6) for c in args.chunk_sizes],
+                  transport=args.transport, adaptive=args.adaptive,
+                  size=int(args.size * 1e6), latency=args.latency,
+                  bandwidth=None if args.bandwidth is None else args.bandwidth * 1e6,
+                  error_rate=args.error_rate, session_ttl=args.session_ttl)
+    sys.exit(0)
@@ -0,0 +1,121 @@
+import os
+import threading
+from catalog import Catalog
+
+SIDECARS = [".sum", ".part", ".manifest"]
+
+
+class GranuleCache:
+    """
+    Treats a granule directory (sgli-lvl1, sgli-lvl2) as a cache with a byte
+    budget. Before a download starts, files are evicted until the new one
+    fits:
+        - files pinned by a stage with queued work on them are never evicted
+        - files some stage has finished with (released) go first, oldest first
+        - then everything else unpinned, least recently used first, the
+          stages touch() a granule when they open it
+    Pins and releases live in the catalog so the downloader, the processors
+    and the extractors can run as separate processes. Paths are stored
+    resolved, a relative cache directory matches the paths the stages pin.
+    """
+    def __init__(self, directory, budget_bytes, catalog=None):
+        self.directory = str(directory)
+        self.budget_bytes = budget_bytes
+        if catalog is None:
+            catalog = Catalog(os.path.join(self.directory, ".cache.db"))
+        self.catalog = catalog
+        # downloads of this process that were given room, path -> expected bytes
+        self.reserved = {}
+        self.lock = threading.Lock()
+
+    def key(self, path):
+        return os.path.realpath(str(path))
+
+    def files(self):
+        # (path, bytes on disk incl. sidecars, last use) of every granule in the directory
+        out = {}
+        directory = self.key(self.directory)
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            base = path
+            for suffix in SIDECARS:
+                if name.endswith(".h5" + suffix):
+                    base = path[:-len(suffix)]
+            if not base.endswith(".h5") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            size, used = out.get(base, (0, 0))
+            out[base] = (size + stat.st_size, max(used, stat.st_atime, stat.st_mtime))
+        return [(path, size, used) for path, (size, used) in out.items()]
+
+    def usage(self):
+        return sum(size for _, size, _ in self.files())
+
+    def pin(self, path, owner, count=1):
+        self.catalog.pin(self.key(path), owner, count)
+
+    def unpin(self, path, owner, count=1):
+        self.catalog.unpin(self.key(path), owner, count)
+
+    def touch(self, path):
+        if os.path.exists(path):
+            os.utime(path)
+
+    def release(self, path):
+        # a stage is done with the file, it becomes a preferred eviction candidate
+        self.catalog.release(self.key(path))
+
+    def evict(self, path):
+        path = self.key(path)
+        for p in [path] + [path + suffix for suffix in SIDECARS]:
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                # another process evicted it first
+                pass
+        self.catalog.forget_release(path)
+        granule_id = os.path.splitext(os.path.basename(path))[0]
+        if self.catalog.state(granule_id) is not None:
+            self.catalog.set_state(granule_id, "evicted", path=path)
+        print("evicted %s" % path)
+
+    def finished(self, path):
+        # the download is over, its file on disk counts for itself now
+        with self.lock:
+            self.reserved.pop(self.key(path), None)
+
+    def ensure_space(self, nbytes=0, path=None):
+        """
+        Evicts until nbytes more fit in the budget. With a path, the room is kept
+        for that download until finished(path), so downloads starting together
+        don't all count the same free space.
+        """
+        with self.lock:
+            files = self.files()
+            used = sum(size for _, size, _ in files)
+            on_disk = dict((f, size) for f, size, _ in files)
+            key = None if path is None else self.key(path)
+            if key is not None:
+                self.reserved[key] = nbytes
+                # a resumed download already has part of its room
+                nbytes = max(nbytes - on_disk.get(key, 0), 0)
+            # room promised to the other downloads that have not filled their file yet
+            used += sum(max(n - on_disk.get(p, 0), 0) for p, n in self.reserved.items() if p != key)
+            if used + nbytes <= self.budget_bytes:
+                return True
+            pinned = self.catalog.pinned()
+            released = self.catalog.released()
+            # released files first (oldest release first), then least recently used
+            candidates = sorted(
+                [f for f in files if f[0] not in pinned and f[0] not in self.reserved],
+                key=lambda f: (f[0] not in released, released.get(f[0], f[2])))
+            for candidate, size, _ in candidates:
+                if used + nbytes <= self.budget_bytes:
+                    break
+                self.evict(candidate)
+                used -= size
+            if used + nbytes > self.budget_bytes:
+                print("cache over budget: %.1f GB used, %.1f GB needed, %.1f GB budget, the rest is pinned" % (
+                    used / 1e9, nbytes / 1e9, self.budget_bytes / 1e9))
+                return False
+            return True
@@ -0,0 +1,160 @@
+import os
+import time
+import sqlite3
+import threading
+
+STATES = ["pending", "downloading", "downloaded", "processed", "failed", "evicted"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS granules (
+    granule_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT NOT NULL,
+    path TEXT,
+    size INTEGER,
+    checksum TEXT,
+    error TEXT,
+    created REAL,
+    updated REAL,
+    PRIMARY KEY (granule_id, stage)
+);
+CREATE INDEX IF NOT EXISTS granules_state ON granules (stage, state);
+CREATE TABLE IF NOT EXISTS pins (
+    path TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, owner, pid)
+);
+CREATE TABLE IF NOT EXISTS releases (
+    path TEXT PRIMARY KEY,
+    released REAL
+);
+"""
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Catalog:
+    """
+    Embedded status table shared by the downloader, the processors and the
+    extractors. A row is one granule (or granule/station product) in one
+    stage, e.g. ("GC1SG1_..._VNRDQ_...", "download") or
+    ("GC1SG1_..._2000_1234", "l2gen"), with its state, size, checksum,
+    timestamps and the last error.
+    """
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def set_state(self, granule_id, state, stage="download", path=None, size=None, checksum=None, error=None):
+        if state not in STATES:
+            raise ValueError("unknown state: %s" % state)
+        now = time.time()
+        with self.lock:
+            # keep whatever we knew about path/size/checksum unless told otherwise
+            self.conn.execute("""
+                INSERT INTO granules (granule_id, stage, state, path, size, checksum, error, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (granule_id, stage) DO UPDATE SET
+                    state = excluded.state,
+                    path = COALESCE(excluded.path, path),
+                    size = COALESCE(excluded.size, size),
+                    checksum = COALESCE(excluded.checksum, checksum),
+                    error = excluded.error,
+                    updated = excluded.updated
+            """, (granule_id, stage, state, None if path is None else str(path), size, checksum, error, now, now))
+            self.conn.commit()
+
+    def get(self, granule_id, stage="download"):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT granule_id, stage, state, path, size, checksum, error, created, updated "
+                "FROM granules WHERE granule_id = ? AND stage = ?", (granule_id, stage))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return dict(zip(["granule_id", "stage", "state", "path", "size", "checksum", "error", "created", "updated"], row))
+
+    def state(self, granule_id, stage="download"):
+        record = self.get(granule_id, stage)
+        return None if record is None else record["state"]
+
+    def ids(self, state, stage="download"):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT granule_id FROM granules WHERE stage = ? AND state = ? ORDER BY granule_id", (stage, state))
+            return [row[0] for row in cur.fetchall()]
+
+    def remaining(self, stage="download"):
+        # everything the stage has seen but not finished, failures included
+        done = "downloaded" if stage == "download" else "processed"
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT granule_id FROM granules WHERE stage = ? AND state != ? ORDER BY granule_id", (stage, done))
+            return [row[0] for row in cur.fetchall()]
+
+    def failed(self, stage="download"):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT granule_id, error FROM granules WHERE stage = ? AND state = 'failed' ORDER BY granule_id", (stage,))
+            return cur.fetchall()
+
+    def summary(self, stage="download"):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT state, COUNT(*) FROM granules WHERE stage = ? GROUP BY state", (stage,))
+            return dict(cur.fetchall())
+
+    # pins keep a file out of GranuleCache eviction while some stage still has
+    # queued work on it, they are counted per (owner, process)
+    def pin(self, path, owner, count=1):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO pins (path, owner, pid, count) VALUES (?, ?, ?, ?)
+                ON CONFLICT (path, owner, pid) DO UPDATE SET count = count + excluded.count
+            """, (str(path), owner, os.getpid(), count))
+            self.conn.commit()
+
+    def unpin(self, path, owner, count=1):
+        with self.lock:
+            self.conn.execute("UPDATE pins SET count = count - ? WHERE path = ? AND owner = ? AND pid = ?",
+                              (count, str(path), owner, os.getpid()))
+            self.conn.execute("DELETE FROM pins WHERE count <= 0")
+            self.conn.commit()
+
+    def pinned(self):
+        # pins of processes that died without unpinning don't count
+        with self.lock:
+            rows = self.conn.execute("SELECT DISTINCT path, pid FROM pins").fetchall()
+        return set(path for path, pid in rows if pid_alive(pid))
+
+    def release(self, path):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO releases (path, released) VALUES (?, ?)",
+                              (str(path), time.time()))
+            self.conn.commit()
+
+    def released(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT path, released FROM releases").fetchall())
+
+    def forget_release(self, path):
+        with self.lock:
+            self.conn.execute("DELETE FROM releases WHERE path = ?", (str(path),))
+            self.conn.commit()
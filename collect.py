@@ -1,5 +1,31 @@
 import pandas as pd
-import numpy as np
+from output import is_parquet, iter_parquet
+
+# the same station in every extractor output
+KEYS = ["Global_ID", "l1b_gportal_id"]
+
+# band names of each extractor output -> the SGLI L2 names used in joined tables
+BAND_NAMES = {
+    "l2": {},
+    "seadas": {"Rrs_529": "Rrs_530", "Rrs_566": "Rrs_565", "Rrs_672": "Rrs_670"},
+    "ocsmart": {"Rrs_672": "Rrs_670"},
+}
+
+
+def read_chunks(f, columns, chunksize):
+    # only `columns` are read, a chunk at a time
+    if is_parquet(f):
+        return iter_parquet(f, columns, chunksize)
+    wanted = set(columns)
+    return pd.read_csv(f, usecols=lambda c: c in wanted, chunksize=chunksize)
+
+
+def key_values(s):
+    # Global_ID is an int in csv outputs, a string in parquet ones, and a float when it has gaps
+    if pd.api.types.is_float_dtype(s) and (s.dropna() % 1 == 0).all():
+        s = s.astype("Int64")
+    return s.astype(str)
+
 
 class Collector:
     def __init__(self, files, columns, important, outfile):
@@ -14,18 +40,89 @@ class Collector:
         return df
     
     def convert_to_nan(self, df):
-        df[df == -1] = np.nan
-        return df
+        return df.mask(df == -1)
     
     def get_important(self, df):
-        return df[self.important]
-
-    def start(self):
-        df = pd.DataFrame(columns = self.columns)
-        for f in self.files:
-            f_df = pd.read_csv(f)
-            df =pd.concat([df, f_df], axis=0)
-        # df = self.filter_df(df[self.important])
-        df = self.convert_to_nan(df)
-        df = self.get_important(df)
-        df.to_csv(self.outfile, index = False)
\ No newline at end of file
+        # columns a file lacks come back as NaN, like concatenating the files did
+        return df.reindex(columns=self.important)
+
+    def read(self, f, chunksize):
+        return read_chunks(f, self.important, chunksize)
+
+    def start(self, chunksize=100000, filter=False):
+        header = True
+        with open(self.outfile, 'w', newline='') as out:
+            for f in self.files:
+                for df in self.read(f, chunksize):
+                    df = self.get_important(df)
+                    df = self.convert_to_nan(df)
+                    if filter:
+                        df = self.filter_df(df)
+                    df.to_csv(out, index = False, header = header)
+                    header = False
+            if header:
+                pd.DataFrame(columns = self.important).to_csv(out, index = False)
+
+
+class Joiner:
+    """
+    One wide comparison table out of several extractor outputs of the same stations.
+    sources is a list of (name, file) with name a BAND_NAMES entry. Every source's
+    bands are renamed to the common names, prefixed with the source name and joined
+    on KEYS. The first source is streamed chunk by chunk, the others are read once
+    with only the `important` columns and looked up by key.
+    """
+
+    def __init__(self, sources, important, outfile, how="inner", keys=KEYS, band_names=BAND_NAMES):
+        if how not in ("inner", "left"):
+            raise ValueError("how must be 'inner' or 'left', got %s" % how)
+        self.sources = sources
+        self.important = [c for c in important if c not in keys]
+        self.outfile = outfile
+        self.how = how
+        self.keys = list(keys)
+        self.band_names = band_names
+
+    def renames(self, name):
+        # source column -> common name, for the columns we keep
+        inverse = dict((common, col) for col, common in self.band_names.get(name, {}).items())
+        return dict((inverse.get(c, c), c) for c in self.important)
+
+    def prepare(self, name, df):
+        df = df.rename(columns=self.renames(name)).reindex(columns=self.keys + self.important)
+        values = df[self.important]
+        df[self.important] = values.mask(values == -1)
+        for k in self.keys:
+            df[k] = key_values(df[k])
+        return df.set_index(self.keys).add_prefix(name + "_")
+
+    def read(self, name, f, chunksize):
+        return read_chunks(f, self.keys + list(self.renames(name)), chunksize)
+
+    def table(self, name, f, chunksize):
+        parts = [self.prepare(name, df) for df in self.read(name, f, chunksize)]
+        if not parts:
+            return self.prepare(name, pd.DataFrame(columns=self.keys))
+        table = pd.concat(parts)
+        duplicated = table.index.duplicated()
+        if duplicated.any():
+            print("%s: %d duplicate stations, keeping the first of each" % (name, duplicated.sum()))
+            table = table[~duplicated]
+        return table
+
+    def start(self, chunksize=100000):
+        (primary, primary_file), others = self.sources[0], self.sources[1:]
+        tables = [self.table(name, f, chunksize) for name, f in others]
+        header = True
+        with open(self.outfile, 'w', newline='') as out:
+            for df in self.read(primary, primary_file, chunksize):
+                df = self.prepare(primary, df)
+                for table in tables:
+                    df = df.join(table, how=self.how)
+                df.reset_index().to_csv(out, index = False, header = header)
+                header = False
+            if header:
+                empty = self.prepare(primary, pd.DataFrame(columns=self.keys))
+                for table in tables:
+                    empty = empty.join(table.iloc[:0])
+                empty.reset_index().to_csv(out, index = False)
@@ -1,13 +1,30 @@
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 import asyncio
 import concurrent.futures
 import functools
 import os
 import json
+import threading
+import time
+import collections
+import random
+from manifest import Manifest
+from integrity import write_sum, BlockHasher, BLOCK_SIZE
+from scheduler import TransferBudget
+from async_transport import AsyncTransport
+from tuning import AdaptiveTuner
+from errors import AuthError, Throttled, RangeError, DownloadError
+
+AUTH_URL = "https://gportal.jaxa.jp/gpr/auth/authenticate.json"
+
 
 class Download:
-  def __init__(self, token, account, password):
+  def __init__(self, token, account, password, pool_connections=4, pool_maxsize=10, pool_block=False,
+               max_connections=None, max_inflight_bytes=None, transport="requests", max_streams=100,
+               adaptive=False, min_chunk_size=250000, max_chunk_size=16000000, cookie_file=None,
+               auth_url=AUTH_URL, max_retries=5, backoff_base=0.5, max_backoff=30., timeout=(10, 60)):
     self.token = token
     self.account = account
     self.password = password
@@ -18,6 +35,59 @@ class Download:
       "Cookie": "fuel_csrf_token=%s"%token
     }
     self.lock = asyncio.Lock()
+    # one keep-alive pool shared by the HEAD, every range GET and later granules
+    self.pool_connections = pool_connections
+    self.pool_maxsize = 0
+    self.pool_block = pool_block
+    self.session = requests.Session()
+    self.mount_pool(pool_maxsize)
+    # shared by every granule in flight, see GranuleScheduler
+    self.budget = TransferBudget(max_connections, max_inflight_bytes)
+    self.stats_lock = threading.Lock()
+    self.bytes_downloaded = 0
+    # "requests" runs ranges on a thread pool, "aiohttp" as coroutines on one loop
+    self.transport = transport
+    self.max_streams = max_streams
+    # adaptive mode retunes range size/concurrency per file, last choice ends up in self.settings
+    self.adaptive = adaptive
+    self.min_chunk_size = min_chunk_size
+    self.max_chunk_size = max_chunk_size
+    self.settings = None
+    # the session cookie is shared by every get(), refreshed only when it expires
+    self.cookie = None
+    self.cookie_file = cookie_file
+    self.auth_lock = threading.Lock()
+    self.auth_generation = 0
+    self.auth_url = auth_url
+    # a failed range is retried on its own, the rest of the file keeps going
+    self.max_retries = max_retries
+    self.backoff_base = backoff_base
+    self.max_backoff = max_backoff
+    self.timeout = timeout
+    self.retries = 0
+    self.failed_ranges = {}
+    # seconds per successful range, for benchmark.py and tuning by hand
+    self.range_latencies = collections.deque(maxlen=100000)
+
+  def mount_pool(self, pool_maxsize):
+    # pool_maxsize only grows, remounting drops the idle connections we already have
+    if pool_maxsize <= self.pool_maxsize:
+      return
+    self.pool_maxsize = pool_maxsize
+    adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                          pool_maxsize=pool_maxsize, pool_block=self.pool_block)
+    self.session.mount("https://", adapter)
+    self.session.mount("http://", adapter)
+
+  def size_pool(self, ranges):
+    # enough keep-alive connections for every range in flight across all granules,
+    # a smaller pool opens the extra ones and throws them away
+    if self.budget.max_connections is not None:
+      ranges = min(ranges, self.budget.max_connections)
+    self.mount_pool(ranges)
+
+  def close(self):
+    self.session.close()
 
   def auth(self):
     self.headers["Cookie"] = "fuel_csrf_token=%s"%self.token
@@ -26,39 +96,284 @@ class Download:
       "password": self.password,
       "fuel_csrf_token": self.token
     } 
-    auth_url = "https://gportal.jaxa.jp/gpr/auth/authenticate.json"
-    res = requests.post(auth_url, body, headers = self.headers)
-    if res.ok:
+    res = self.session.post(self.auth_url, body, headers = self.headers)
+    if res.ok and "Set-Cookie" in res.headers:
       cookie = res.headers["Set-Cookie"].split("secure, ")[-1]
       print("auth completed, cookie: " + cookie)
-      self.headers["Cookie"] = cookie
+      self.set_cookie(cookie)
+      self.save_cookie()
     else:
-      print("auth failed ! : ") 
-      # print(res.content)
-      # print(res.request.body)
-      # print(res.request.method)
-      # print(res.request.headers)
-      # print(res.status_code)
+      raise AuthError("auth failed with status %d" % res.status_code)
+
+  def set_cookie(self, cookie):
+    self.cookie = cookie
+    self.headers["Cookie"] = cookie
+    self.auth_generation += 1
+
+  def load_cookie(self):
+    if self.cookie_file is None or not os.path.exists(self.cookie_file):
+      return False
+    try:
+      with open(self.cookie_file, 'r') as f:
+        self.set_cookie(json.load(f)["cookie"])
+    except (ValueError, KeyError):
+      return False
+    print("using saved session cookie")
+    return True
+
+  def save_cookie(self):
+    if self.cookie_file is None:
+      return
+    tmp = "%s.tmp" % self.cookie_file
+    with open(tmp, 'w') as f:
+      json.dump({"cookie": self.cookie, "time": time.time()}, f)
+    os.replace(tmp, self.cookie_file)
+
+  def ensure_auth(self):
+    with self.auth_lock:
+      if self.cookie is None and not self.load_cookie():
+        self.auth()
+
+  def reauth(self, generation):
+    # every range that saw the expiry calls this, only the first one logs in again
+    with self.auth_lock:
+      if generation == self.auth_generation:
+        print("session expired, authenticating again")
+        self.auth()
+
+  def is_expired(self, status, url, content_type):
+    if status in (401, 403):
+      return True
+    # an expired session gets redirected to the login page instead of the data
+    return "login" in str(url) or str(content_type).startswith("text/html")
 
   async def get_size(self, url):
-    response = requests.head(url, headers=self.headers)
-    size = int(response.headers['Content-Length'])
-    return size
+    return self.head_size(url)
 
-  def download_range(self, url, start, end, output):
+  def head_size(self, url):
+    for attempt in range(2):
+      generation = self.auth_generation
+      response = self.session.head(url, headers=self.headers, allow_redirects=True, timeout=self.timeout)
+      if not self.is_expired(response.status_code, response.url, response.headers.get('Content-Type', '')):
+        return int(response.headers['Content-Length'])
+      if attempt == 1:
+        raise AuthError("session rejected for %s after re-authenticating" % url)
+      self.reauth(generation)
+
+  def count(self, nbytes):
+    with self.stats_lock:
+      self.bytes_downloaded += nbytes
+
+  def download_range(self, url, start, end, output, pbar):
     headers = {'Range': f'bytes={start}-{end}'}
     headers.update(self.headers)
-    response = requests.get(url, headers=headers)
+    with self.budget.reserve(end - start + 1):
+      response = self.session.get(url, headers=headers)
 
     with open(output, 'wb') as f:
         for part in response.iter_content(1024):
             f.write(part)
-    self.pbar.update(1)
+    self.count(len(response.content))
+    pbar.update(1)
+
+  def open_range(self, url, start, end, reauth_limit=3):
+    # GET one range, logging in again if the session expired, returns the streaming 206 response
+    for attempt in range(reauth_limit + 1):
+      generation = self.auth_generation
+      headers = {'Range': f'bytes={start}-{end}'}
+      headers.update(self.headers)
+      response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+      if response.status_code in (429, 503):
+        response.close()
+        raise Throttled("HTTP %d for range %d-%d" % (response.status_code, start, end))
+      if not self.is_expired(response.status_code, response.url, response.headers.get('Content-Type', '')):
+        break
+      response.close()
+      if attempt == reauth_limit:
+        raise AuthError("session still rejected for range %d-%d after re-authenticating" % (start, end))
+      self.reauth(generation)
+    if response.status_code != 206:
+      response.close()
+      raise RangeError("HTTP %d for range %d-%d" % (response.status_code, start, end))
+    return response
+
+  def write_range(self, url, start, end, fd, manifest, pbar):
+    # stream the range straight into its offset of the preallocated file
+    offset = start
+    with self.budget.reserve(end - start + 1):
+      response = self.open_range(url, start, end)
+      # the block digests are computed on the fly, see integrity.py
+      digest = BlockHasher(start, end, manifest.size)
+      try:
+        for part in response.iter_content(65536):
+            if offset + len(part) > end + 1:
+              raise RangeError("range %d-%d: server sent more than asked for" % (start, end))
+            os.pwrite(fd, part, offset)
+            digest.update(part)
+            offset += len(part)
+      finally:
+        response.close()
+        self.count(offset - start)
+    if offset != end + 1:
+      raise RangeError("short range %d-%d: got %d bytes" % (start, end, offset - start))
+    manifest.add(start, end, digest.hexdigest())
+    pbar.update(end - start + 1)
 
-  async def download(self, run, loop, url, output, chunk_size=1000000):
+  def read_range(self, url, start, end):
+    # bytes start..end of the remote file in memory, retried like a download range
+    for attempt in range(self.max_retries + 1):
+      try:
+        with self.budget.reserve(end - start + 1):
+          response = self.open_range(url, start, end)
+          try:
+            data = response.content
+          finally:
+            response.close()
+        self.count(len(data))
+        if len(data) != end - start + 1:
+          raise RangeError("range %d-%d: got %d bytes" % (start, end, len(data)))
+        return data
+      except AuthError:
+        raise
+      except Exception as e:
+        if attempt == self.max_retries:
+          raise
+        with self.stats_lock:
+          self.retries += 1
+        time.sleep(self.backoff(attempt))
+
+  def allocate(self, output, file_size, fresh=False):
+    fd = os.open(output, os.O_RDWR | os.O_CREAT, 0o644)
+    if fresh:
+      # nothing of an old .part is kept, it may belong to another version of the file
+      os.ftruncate(fd, 0)
+    # fallocate only ever grows a file, the .part has to be exactly file_size bytes
+    os.ftruncate(fd, file_size)
+    try:
+      os.posix_fallocate(fd, 0, file_size)
+    except (AttributeError, OSError):
+      # not every platform/filesystem supports fallocate, a sparse file will do
+      pass
+    return fd
+
+  def backoff(self, attempt):
+    # exponential backoff with full jitter so retries don't come back in lockstep
+    return random.uniform(0, min(self.max_backoff, self.backoff_base * 2 ** attempt))
+
+  async def fetch_after(self, delay, fetch, *args):
+    await asyncio.sleep(delay)
+    await fetch(*args)
+
+  async def dispatch(self, fetch, gaps, fd, manifest, pbar, chunk_size, max_concurrency, tuner):
+    # carve ranges off the front of the gaps, keeping at most `concurrency` in flight,
+    # failed ranges go back in through `retry` after their backoff
+    gaps = collections.deque(gaps)
+    retry = collections.deque()
+    pending = {}
+    attempts = {}
+    failed = []
+    error = None
+    while ((gaps or retry) and error is None) or pending:
+      concurrency = tuner.concurrency if tuner else max_concurrency
+      size = tuner.chunk_size if tuner else chunk_size
+      while (gaps or retry) and error is None and len(pending) < concurrency:
+        if retry:
+          start, end, delay = retry.popleft()
+          task = asyncio.ensure_future(self.fetch_after(delay, fetch, start, end, fd, manifest, pbar))
+        else:
+          start, end = gaps.popleft()
+          stop = min(start + size, end + 1)
+          if stop <= end and size >= BLOCK_SIZE:
+            # cut on a block boundary so every checksum block streams through one range
+            stop = stop // BLOCK_SIZE * BLOCK_SIZE
+          if stop <= end:
+            gaps.appendleft((stop, end))
+          end = stop - 1
+          task = asyncio.ensure_future(fetch(start, end, fd, manifest, pbar))
+        pending[task] = (start, end, time.time())
+
+      done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        start, end, started = pending.pop(task)
+        try:
+          task.result()
+        except AuthError as e:
+          # let the ranges already running finish before the fd gets closed
+          error = error or e
+          continue
+        except Exception as e:
+          if isinstance(e, Throttled) and tuner:
+            tuner.throttled()
+          attempt = attempts.get((start, end), 0)
+          if attempt >= self.max_retries:
+            print("range %d-%d failed permanently: %s" % (start, end, e))
+            failed.append((start, end, str(e)))
+            continue
+          attempts[(start, end)] = attempt + 1
+          with self.stats_lock:
+            self.retries += 1
+          delay = self.backoff(attempt)
+          print("range %d-%d failed (%s), retry %d in %.1f s" % (start, end, e, attempt + 1, delay))
+          retry.append((start, end, delay))
+          continue
+        if (start, end) not in attempts:
+          self.range_latencies.append(time.time() - started)
+          if tuner:
+            tuner.record(end - start + 1, time.time() - started)
+    if error is not None:
+      raise error
+    return failed, sum(attempts.values())
+
+  async def download_resumable(self, fetch, output, file_size, chunk_size, max_concurrency):
+    # data goes to {output}.part and only gets renamed into place once every
+    # range is on disk, so a file at `output` is always complete
+    part = "%s.part" % output
+    manifest = Manifest("%s.manifest" % output, file_size)
+    if os.path.exists(part):
+      manifest.load()
+    else:
+      manifest.reset()
+    gaps = manifest.missing(max(file_size, 1))
+    remaining = sum(end - start + 1 for start, end in gaps)
+    if len(manifest.done):
+      print("resuming, %d bytes left" % remaining)
+
+    tuner = None
+    if self.adaptive:
+      tuner = AdaptiveTuner(chunk_size, max(max_concurrency // 2, 1),
+                            self.min_chunk_size, self.max_chunk_size, max_concurrency)
+
+    fd = self.allocate(part, file_size, fresh=not manifest.done)
+    pbar = tqdm(total=remaining, unit='B', unit_scale=True)
+    try:
+      failed, retries = await self.dispatch(fetch, gaps, fd, manifest, pbar, chunk_size, max_concurrency, tuner)
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+      pbar.close()
+    if retries:
+      print("%d range retries for %s" % (retries, output))
+    if failed:
+      # the good ranges stay in the manifest, the next get() only fetches these
+      self.failed_ranges[str(output)] = failed
+      raise DownloadError(output, failed)
+    if tuner:
+      self.settings = tuner.settings()
+      print("adaptive settings: chunk_size=%d concurrency=%d" % (self.settings["chunk_size"], self.settings["concurrency"]))
+    checksum = write_sum(output, file_size, manifest.ranges(), part)
+    os.replace(part, output)
+    manifest.remove()
+    print("checksum %s: %s" % (output, checksum))
+
+  async def download(self, run, loop, url, output, chunk_size=1000000, preallocate=True, max_workers=3):
     file_size = await self.get_size(url)
+    if preallocate:
+      fetch = functools.partial(run, self.write_range, url)
+      await self.download_resumable(fetch, output, file_size, chunk_size, max_workers)
+      return
+
     chunks = range(0, file_size, chunk_size)
-    self.pbar = tqdm(total=len(chunks))
+    pbar = tqdm(total=len(chunks))
     tasks = [
         run(
             self.download_range,
@@ -66,12 +381,13 @@ class Download:
             start,
             start + chunk_size - 1,
             f'{output}.part{i}',
+            pbar,
         )
         for i, start in enumerate(chunks)
     ]
 
     await asyncio.wait(tasks)
-    self.pbar.close()
+    pbar.close()
     with open(output, 'wb') as o:
         for i in range(len(chunks)):
             chunk_path = f'{output}.part{i}'
@@ -82,8 +398,19 @@ class Download:
             os.remove(chunk_path)
 
 
-  def get(self, url, out, max_workers=3):
-    self.auth()
+  def get(self, url, out, max_workers=3, preallocate=True, chunk_size=1000000):
+    self.ensure_auth()
+    if self.transport == "aiohttp":
+      # ranges are written in place, so this path is always preallocated
+      loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(loop)
+      try:
+        loop.run_until_complete(AsyncTransport(self, self.max_streams).run(url, out, chunk_size))
+      finally:
+        loop.close()
+      return
+
+    self.mount_pool(max_workers)
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
     loop = asyncio.new_event_loop()
     run = functools.partial(loop.run_in_executor, executor)
@@ -91,7 +418,8 @@ class Download:
     asyncio.set_event_loop(loop)
     try:
         loop.run_until_complete(
-            self.download(run, loop, url, out)
+            self.download(run, loop, url, out, chunk_size=chunk_size, preallocate=preallocate, max_workers=max_workers)
         )
     finally:
-        loop.close()
\ No newline at end of file
+        loop.close()
+        executor.shutdown()
\ No newline at end of file
@@ -8,6 +8,8 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 from download import Download
+from scheduler import GranuleScheduler
+from integrity import verify, read_sum, parse_size
 
 
 """
@@ -19,60 +21,166 @@ An HDF5 file contains datasets & groups
 
 
 class Downloader:
-    def __init__(self, csv_path, path, token, account, password):
+    def __init__(self, csv_path, path, token, account, password, pool_connections=4, pool_maxsize=20,
+                 max_granules=1, max_connections=None, max_inflight_bytes=None, transport="requests", max_streams=100,
+                 adaptive=False, cookie_file=None, max_retries=5, verify_checksums=True, catalog=None,
+                 cache=None):
         self.path = Path(path)
         self.in_file = Path(csv_path)
         self.token = token
         self.account = account
         self.password = password
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        # granules downloading at once, and the global limits they share
+        self.max_granules = max_granules
+        self.max_connections = max_connections
+        self.max_inflight_bytes = max_inflight_bytes
+        self.transport = transport
+        self.max_streams = max_streams
+        self.adaptive = adaptive
+        self.cookie_file = cookie_file
+        self.max_retries = max_retries
+        # re-hash existing granules against their recorded checksum before skipping them
+        self.verify_checksums = verify_checksums
+        # optional catalog.Catalog, granules are tracked under the "download" stage
+        self.catalog = catalog
+        self.row_files = {}
+        # optional cache.GranuleCache over self.path, makes room before each download
+        self.cache = cache
+        self.expected_sizes = {}
+
+    def get_downloader(self):
+        return Download(self.token, self.account, self.password,
+                        pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                        max_connections=self.max_connections, max_inflight_bytes=self.max_inflight_bytes,
+                        transport=self.transport, max_streams=self.max_streams, adaptive=self.adaptive,
+                        cookie_file=self.cookie_file, max_retries=self.max_retries)
+
+    def granule_id(self, path):
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def started(self, url, path):
+        if self.cache is not None:
+            self.cache.ensure_space(self.expected_sizes.get(path) or 0, path)
+        if self.catalog is not None:
+            self.catalog.set_state(self.granule_id(path), "downloading", path=path)
+
+    def finished(self, url, path, error):
+        if self.cache is not None:
+            self.cache.finished(path)
+        if self.catalog is None:
+            return
+        if error is None:
+            record = read_sum(path) or {}
+            self.catalog.set_state(self.granule_id(path), "downloaded", path=path,
+                                   size=os.path.getsize(path), checksum=record.get("checksum"))
+        else:
+            self.catalog.set_state(self.granule_id(path), "failed", path=path, error=str(error))
+
+    def is_complete(self, downloader, link, path, expected_size=None):
+        if not os.path.exists(path):
+            return False
+        if self.catalog is not None:
+            # the catalog already vouched for this file, a stat is enough
+            record = self.catalog.get(self.granule_id(path))
+            if record is not None and record["state"] == "downloaded" and record["size"] == os.path.getsize(path):
+                print("already exist: %s" % os.path.basename(path))
+                return True
+        if expected_size is None and read_sum(path) is None:
+            # neither the csv nor an earlier download knows the size, ask the server
+            downloader.ensure_auth()
+            expected_size = downloader.head_size(link)
+        if verify(path, expected_size, self.verify_checksums):
+            print("already exist: %s" % os.path.basename(path))
+            if self.catalog is not None:
+                record = read_sum(path) or {}
+                self.catalog.set_state(self.granule_id(path), "downloaded", path=path,
+                                       size=os.path.getsize(path), checksum=record.get("checksum"))
+            return True
+        print("truncated or corrupt, downloading again: %s" % path)
+        return False
+
+    def remote_size(self, downloader, link):
+        try:
+            downloader.ensure_auth()
+            return downloader.head_size(link)
+        except Exception as e:
+            # get() will fail on it too, there is just nothing to make room for
+            print("cannot get the size of %s: %s" % (link, e))
+            return None
+
+    def run_jobs(self, downloader, jobs):
+        scheduler = GranuleScheduler(downloader, self.max_granules)
+        if self.catalog is not None:
+            for url, path, _ in jobs:
+                self.catalog.set_state(self.granule_id(path), "pending", path=path)
+        try:
+            failed = scheduler.run(jobs, self)
+        finally:
+            downloader.close()
+        print("downloaded %d of %d files, %d range retries" % (len(jobs) - len(failed), len(jobs), downloader.retries))
+        return failed
+
+    def add_granule(self, granules, rows, i, link, expected_size, max_workers):
+        # rows sharing a scene point at the same file, it is only queued once
+        path = os.path.join(self.path, link.split("/")[-1])
+        if path not in granules:
+            granules[path] = (link, expected_size, max_workers)
+        rows.setdefault(i, []).append(path)
+
+    def download_granules(self, granules, rows):
+        print("%d rows need %d unique granules" % (len(rows), len(granules)))
+        downloader = self.get_downloader()
+        jobs = []
+        for path, (link, expected_size, max_workers) in granules.items():
+            self.expected_sizes[path] = expected_size
+            if self.cache is not None:
+                # nothing this run needs gets evicted to make room for the rest of it
+                self.cache.pin(path, "download")
+            if not self.is_complete(downloader, link, path, expected_size):
+                if self.cache is not None and expected_size is None:
+                    # the cache has to know how much room to make, IRSDQ sizes are never in the csv
+                    self.expected_sizes[path] = self.remote_size(downloader, link)
+                jobs.append((link, path, max_workers))
+        try:
+            failed = self.run_jobs(downloader, jobs)
+        finally:
+            if self.cache is not None:
+                for path in granules:
+                    self.cache.unpin(path, "download")
+        # map the rows back to their files, row index -> local paths
+        failed_paths = set(path for _, path, _ in failed)
+        self.row_files = rows
+        ready = [i for i, paths in rows.items() if not failed_paths.intersection(paths)]
+        print("%d of %d rows have all their granules" % (len(ready), len(rows)))
+        return failed
 
     def download_l2(self, from_index=0):
         in_df = pd.read_csv(self.in_file)
-        downloader = Download(self.token, self.account, self.password)
+        granules = {}
+        rows = {}
         for i in range(from_index, len(in_df)):
-            print("downloading row # %d" % i)
             row = in_df.iloc[i]
             rrs_link = str(row["l2_rrs_gportal_link"])
             prod_link = str(row["l2_prod_gportal_link"])
             if rrs_link == 'nan' or prod_link == 'nan':
                 continue
-            try:
-                rrs_name = rrs_link.split("/")[-1]
-                prod_name = prod_link.split("/")[-1]
-                downloader.get(rrs_link, os.path.join(self.path, rrs_name), 20)
-                downloader.get(prod_link, os.path.join(
-                    self.path, prod_name), 20)
-            except:
-                print("cannot download!")
-                continue
-            print("download complete for row # %d" % i)
+            self.add_granule(granules, rows, i, rrs_link, parse_size(row.get("l2_rrs_gportal_size")), 20)
+            self.add_granule(granules, rows, i, prod_link, parse_size(row.get("l2_prod_gportal_size")), 20)
+        return self.download_granules(granules, rows)
 
     def download_l1B(self, from_index=0):
         in_df = pd.read_csv(self.in_file)
-        downloader = Download(self.token, self.account, self.password)
+        granules = {}
+        rows = {}
         for i in range(from_index, len(in_df)):
-            print("downloading row # %d" % i)
             row = in_df.iloc[i]
             vnrdq_link = str(row["l1b_gportal_link"])
             if vnrdq_link == 'nan':
                 continue
-            try:
-                vnrdq_name = vnrdq_link.split("/")[-1]
-                irsdq_link = vnrdq_link.replace("VNRDQ", "IRSDQ")
-                irsdq_name = irsdq_link.split("/")[-1]
-                print("VNRDQ")
-                vnrdq_path = os.path.join(self.path, vnrdq_name)
-                if not os.path.exists(vnrdq_path):
-                    downloader.get(vnrdq_link, vnrdq_path, 10)
-                else:
-                    print("already exist")
-                print("IRSDQ")
-                irsdq_path = os.path.join(self.path, irsdq_name)
-                if not os.path.exists(irsdq_path):
-                    downloader.get(irsdq_link, irsdq_path, 10)
-                else:
-                    print("already exist")
-            except:
-                print("cannot download!")
-                continue
-            print("download complete for row # %d" % i)
+            irsdq_link = vnrdq_link.replace("VNRDQ", "IRSDQ")
+            # l1b_gportal_size is the VNRDQ size, the IRSDQ one comes from the server
+            self.add_granule(granules, rows, i, vnrdq_link, parse_size(row.get("l1b_gportal_size")), 10)
+            self.add_granule(granules, rows, i, irsdq_link, None, 10)
+        return self.download_granules(granules, rows)
@@ -0,0 +1,21 @@
+class AuthError(Exception):
+  """G-Portal refused the login, or kept refusing the session after a fresh one."""
+  pass
+
+
+class Throttled(IOError):
+  """Server pushed back on a range (429/503), it should be retried at lower concurrency."""
+  pass
+
+
+class RangeError(IOError):
+  """A range came back with the wrong status or the wrong number of bytes."""
+  pass
+
+
+class DownloadError(IOError):
+  """Some ranges of a file still failed after all their retries."""
+  def __init__(self, output, failed):
+    self.output = output
+    self.failed = failed
+    super().__init__("%d ranges of %s failed permanently" % (len(failed), output))
@@ -3,13 +3,25 @@ import netCDF4 as nc
 import pandas as pd
 import os
 from pathlib import Path
-FLAGS = ['ATMFAIL', 'LAND', 'PRODWARN', 'HIGLINT', 'HILT', 'HISATZEN', 'COASTZ', 'SPARE', 'STRAYLIGHT', 'CLDICE', 'COCCOLITH', 'TURBIDW', 'HISOLZEN', 'SPARE', 'LOWLW', 'CHLFAIL', 'NAVWARN', 'ABSAER', 'SPARE', 'MAXAERITER', 'MODGLINT', 'CHLWARN', 'ATMWARN', 'SPARE', 'SEAICE', 'NAVFAIL', 'FILTER', 'SPARE', 'BOWTIEDEL', 'HIPOL', 'PRODFAIL', 'SPARE']
-INVALID = ["ATMFAIL", "LAND", "HIGLINT", "HILT", "STRAYLIGHT", "CLDICE", "LOWLW", "NAVFAIL", "NAVWARN"]
+from geolocation import GeoIndex, IndexCache
+from grouping import group_rows, OrderedRows
+from parallel import run_serial, run_parallel
+from output import open_writer
+from flags import get_table
+from validity import validity_map
 COLUMNS = ['MATCHUP_VALID','lat', 'lon', 'Kd_490', 'Rrs_380', 'Rrs_412', 'Rrs_443', 'Rrs_490', 'Rrs_529', 'Rrs_566', 'Rrs_672', 'a_380_qaa', 'a_412_qaa', 'a_443_qaa', 'a_490_qaa', 'a_566_qaa', 'a_672_qaa', 'adg_380_qaa', 'adg_412_qaa', 'adg_443_qaa', 'adg_490_qaa', 'adg_529_qaa', 'adg_566_qaa', 'adg_672_qaa', 'angstrom', 'aot_867', 'aph_380_qaa', 'aph_412_qaa', 'aph_443_qaa', 'aph_490_qaa', 'aph_529_qaa', 'aph_566_qaa', 'aph_672_qaa', 'chlor_a', 'l2_flags', 'in_situ_lat', 'in_situ_lon', 'Global_ID', 'Date', 'l1b_gportal_id']
+# parquet column types, every band is float32
+TYPES = dict.fromkeys(COLUMNS, "float32")
+TYPES.update({"MATCHUP_VALID": "bool", "l2_flags": "uint32", "in_situ_lat": "float64", "in_situ_lon": "float64",
+              "Global_ID": "string", "Date": "string", "l1b_gportal_id": "string"})
 class ExtractorSeaDAS:
-    def __init__(self, input_csv, output_csv):
+    def __init__(self, input_csv, output_csv, catalog=None):
         self.out_file = Path(output_csv)
         self.input_csv = Path(input_csv)
+        # optional catalog.Catalog, rows are tracked under the "extract_seadas" stage
+        self.catalog = catalog
+        self.indexes = IndexCache()
+        self.flags = get_table("seadas")
 
     def get_nc_file(self, path):
         print("reading file: %s" % path)
@@ -21,16 +33,6 @@ class ExtractorSeaDAS:
         lon = nc_ds["navigation_data"]["longitude"][:].data
         return lat, lon
 
-    def distance_sqr(self, lat, df_lat, lon, df_lon):
-        lat_diff = (df_lat - lat)
-        lon_diff = (df_lon - lon)
-        return lat_diff * lat_diff + lon_diff * lon_diff
-
-    def find_entry(self, lat_mat, lon_mat, lat, lon):
-        dist = self.distance_sqr(lat, lat_mat, lon, lon_mat)
-        row, col = np.where(dist == np.min(dist))
-        return row, col, dist[row, col]
-    
     def get_product(self, row, column, nc_ds, product_name):
         p = nc_ds["geophysical_data"][product_name][:]
         if product_name == "l2_flags":
@@ -41,29 +43,17 @@ class ExtractorSeaDAS:
             return p.data[row, column]
         
     def get_p_flags(self, value):
-        f = []
-        order = 0
-        while value > 0:
-            rem = value % 2
-            value //= 2
-            if rem:
-                f.append(FLAGS[order])
-            order += 1
-        return f
-    
+        return self.flags.decode(value)
+
     def validate_p(self, value):
-        f = self.get_p_flags(value)
-        return np.intersect1d(f, INVALID).shape[0] == 0
-        
+        return self.flags.valid(value)
+
     def validate_matchup(self, row, column, nc_ds):
         print(" r, c", row, column)
         flgs = nc_ds["geophysical_data"].variables["l2_flags"][:].data[row-1: row+2, column-1:column+2]
-        vld = []
-        for i in range(3):
-            vld.append([])
-            for j in range(3):
-                vld[i].append(self.validate_p(flgs[i, j]))
-        vld = np.array(vld,dtype=np.bool)
+        if flgs.shape != (3, 3):
+            return False
+        vld = self.flags.valid(flgs)
         if vld[1, 1] == False: return False
         n_vld = np.sum(vld)
         if n_vld < 5: return False
@@ -72,90 +62,134 @@ class ExtractorSeaDAS:
         if cv > 0.15: return False
         return True
 
+    def matchup_map(self, nc_ds, window=None, size=3):
+        # validate_matchup for every pixel of the scene, or of a (r0, r1, c0, c1) window
+        r0, r1, c0, c1 = window or (0, None, 0, None)
+        flgs = nc_ds["geophysical_data"].variables["l2_flags"][r0:r1, c0:c1].data
+        rrs_443 = nc_ds["geophysical_data"].variables["Rrs_443"][r0:r1, c0:c1].data
+        return validity_map(self.flags.valid(flgs), rrs_443, size)
+
+
 
+    def product_paths(self, row):
+        vnr_id = row["l1b_gportal_id"]
+        product_id = vnr_id[0:25] + "_" + str(row["Global_ID"])
+        nc_path = "/home/shared/Data/SGLI/seadas_processed_large_with_land/" + product_id + ".nc"
+        return product_id, nc_path
 
-    def start(self, start_index=0):
+    def open_granules(self, path):
+        return (self.get_nc_file(path),)
+
+    def group_key(self, row):
+        if type(row["l1b_gportal_id"]) != str:
+            return None
+        return self.product_paths(row)[1]
+
+    def process_row(self, row, granules):
+        if type(row["l1b_gportal_id"]) != str:
+            return None
+        nc_path = self.product_paths(row)[1]
+        nc_ds, = granules.get(nc_path, nc_path)
+        # stations sharing a file reuse its index
+        index = self.indexes.get(nc_path, lambda: GeoIndex(*self.get_lat_lon_data(nc_ds)))
+        r, c, d = index.query(row["lat"], row["lon"])
+        lat_mat, lon_mat = index.lat, index.lon
+        #check matchup valid 5x5 flags
+        print("found entry at %d and %d with dist = %f km"%(r, c, d))
+        try:
+            is_valid = self.validate_matchup(r, c, nc_ds)
+        except:
+            is_valid = False
+        if not is_valid:
+            print("invalid matchup")
+        else:
+            print("VALID!")
+        l2 = {
+            "lat": lat_mat[r, c],
+            "lon": lon_mat[r, c],
+            "Kd_490": self.get_product(r, c, nc_ds, "Kd_490"),
+            "Rrs_380": self.get_product(r, c, nc_ds, "Rrs_380"),
+            "Rrs_412": self.get_product(r, c, nc_ds, "Rrs_412"),
+            "Rrs_443": self.get_product(r, c, nc_ds, "Rrs_443"),
+            "Rrs_490": self.get_product(r, c, nc_ds, "Rrs_490"),
+            "Rrs_529": self.get_product(r, c, nc_ds, "Rrs_529"),
+            "Rrs_566": self.get_product(r, c, nc_ds, "Rrs_566"),
+            "Rrs_672": self.get_product(r, c, nc_ds, "Rrs_672"),
+            "a_380_qaa": self.get_product(r, c, nc_ds, "a_380_qaa"),
+            "a_412_qaa": self.get_product(r, c, nc_ds, "a_412_qaa"),
+            "a_443_qaa": self.get_product(r, c, nc_ds, "a_443_qaa"),
+            "a_490_qaa": self.get_product(r, c, nc_ds, "a_529_qaa"),
+            "a_566_qaa": self.get_product(r, c, nc_ds, "a_566_qaa"),
+            "a_672_qaa": self.get_product(r, c, nc_ds, "a_672_qaa"),
+            "adg_380_qaa": self.get_product(r, c, nc_ds, "adg_380_qaa"),
+            "adg_412_qaa": self.get_product(r, c, nc_ds, "adg_412_qaa"),
+            "adg_443_qaa": self.get_product(r, c, nc_ds, "adg_443_qaa"),
+            "adg_490_qaa": self.get_product(r, c, nc_ds, "adg_490_qaa"),
+            "adg_529_qaa": self.get_product(r, c, nc_ds, "adg_529_qaa"),
+            "adg_566_qaa": self.get_product(r, c, nc_ds, "adg_566_qaa"),
+            "adg_672_qaa": self.get_product(r, c, nc_ds, "adg_672_qaa"),
+            "angstrom": self.get_product(r, c, nc_ds, "angstrom"),
+            "aot_867": self.get_product(r, c, nc_ds, "aot_867"),
+            "aph_380_qaa": self.get_product(r, c, nc_ds, "aph_380_qaa"),
+            "aph_412_qaa": self.get_product(r, c, nc_ds, "aph_412_qaa"),
+            "aph_443_qaa": self.get_product(r, c, nc_ds, "aph_443_qaa"),
+            "aph_490_qaa": self.get_product(r, c, nc_ds, "aph_490_qaa"),
+            "aph_529_qaa": self.get_product(r, c, nc_ds, "aph_529_qaa"),
+            "aph_566_qaa": self.get_product(r, c, nc_ds, "aph_566_qaa"),
+            "aph_672_qaa": self.get_product(r, c, nc_ds, "aph_672_qaa"),
+            "chlor_a": self.get_product(r, c, nc_ds, "chlor_a"),
+            "l2_flags": self.get_product(r, c, nc_ds, "l2_flags"),
+            "in_situ_lat": row["lat"],
+            "in_situ_lon": row["lon"],
+            "Global_ID": row["Global_ID"],
+            "Date": row["Date"],
+            "l1b_gportal_id": row["l1b_gportal_id"],
+            "MATCHUP_VALID": is_valid
+        }
+        return l2, is_valid
+
+    def record_row(self, i, row, result, error):
+        if type(row["l1b_gportal_id"]) != str:
+            return
+        product_id = self.product_paths(row)[0]
+        if error is not None:
+            print("row %d failed: %s" % (i, error))
+            if self.catalog is not None:
+                self.catalog.set_state(product_id, "failed", stage="extract_seadas", error=error)
+        elif result is not None and self.catalog is not None:
+            self.catalog.set_state(product_id, "processed", stage="extract_seadas", path=self.out_file)
+
+    def start(self, start_index=None, grouped=False, workers=1, sync_every=10, output="csv"):
         in_df = pd.read_csv(self.input_csv)
         print(len(in_df))
-        out_df = pd.DataFrame(columns=COLUMNS)
-        n = 0
+        # with no start_index the previous run resumes at its last checkpoint
+        # output="parquet" writes a typed part directory at out_file instead of a csv
+        writer = open_writer(self.out_file, COLUMNS, TYPES, output, sync_every)
+        start_index = writer.open(start_index)
         vld = 0
         invld = 0
-        for i in range(start_index, in_df.shape[0]):
-            row = in_df.iloc[i]
-            print("processing file #: ", i)
-            if type(row["l1b_gportal_id"]) != str:
-                continue
-            vnr_id = row["l1b_gportal_id"]
-            nc_path = "/home/shared/Data/SGLI/seadas_processed_large_with_land/"+vnr_id[0:25] + "_" + str(row["Global_ID"]) + ".nc"
-            try:
-                nc_ds = self.get_nc_file(nc_path)
-            except:
-                continue
-            lat_mat, lon_mat = self.get_lat_lon_data(nc_ds)
-            r, c, d = self.find_entry(lat_mat, lon_mat, row["lat"], row["lon"])
-            #check matchup valid 5x5 flags
-            r = r[0]
-            c = c[0]
-            print("found entry at %d and %d with dist = %f"%(r, c, d))
-            try:
-                is_valid = self.validate_matchup(r, c, nc_ds)
-            except:
-                is_valid = False
-            if not is_valid:
-                print("invalid matchup")
-                invld += 1
-            else:
-                print("VALID!")
-                vld += 1
-            l2 = {
-                "lat": lat_mat[r, c],
-                "lon": lon_mat[r, c],
-                "Kd_490": self.get_product(r, c, nc_ds, "Kd_490"),
-                "Rrs_380": self.get_product(r, c, nc_ds, "Rrs_380"),
-                "Rrs_412": self.get_product(r, c, nc_ds, "Rrs_412"),
-                "Rrs_443": self.get_product(r, c, nc_ds, "Rrs_443"),
-                "Rrs_490": self.get_product(r, c, nc_ds, "Rrs_490"),
-                "Rrs_529": self.get_product(r, c, nc_ds, "Rrs_529"),
-                "Rrs_566": self.get_product(r, c, nc_ds, "Rrs_566"),
-                "Rrs_672": self.get_product(r, c, nc_ds, "Rrs_672"),
-                "a_380_qaa": self.get_product(r, c, nc_ds, "a_380_qaa"),
-                "a_412_qaa": self.get_product(r, c, nc_ds, "a_412_qaa"),
-                "a_443_qaa": self.get_product(r, c, nc_ds, "a_443_qaa"),
-                "a_490_qaa": self.get_product(r, c, nc_ds, "a_529_qaa"),
-                "a_566_qaa": self.get_product(r, c, nc_ds, "a_566_qaa"),
-                "a_672_qaa": self.get_product(r, c, nc_ds, "a_672_qaa"),
-                "adg_380_qaa": self.get_product(r, c, nc_ds, "adg_380_qaa"),
-                "adg_412_qaa": self.get_product(r, c, nc_ds, "adg_412_qaa"),
-                "adg_443_qaa": self.get_product(r, c, nc_ds, "adg_443_qaa"),
-                "adg_490_qaa": self.get_product(r, c, nc_ds, "adg_490_qaa"),
-                "adg_529_qaa": self.get_product(r, c, nc_ds, "adg_529_qaa"),
-                "adg_566_qaa": self.get_product(r, c, nc_ds, "adg_566_qaa"),
-                "adg_672_qaa": self.get_product(r, c, nc_ds, "adg_672_qaa"),
-                "angstrom": self.get_product(r, c, nc_ds, "angstrom"),
-                "aot_867": self.get_product(r, c, nc_ds, "aot_867"),
-                "aph_380_qaa": self.get_product(r, c, nc_ds, "aph_380_qaa"),
-                "aph_412_qaa": self.get_product(r, c, nc_ds, "aph_412_qaa"),
-                "aph_443_qaa": self.get_product(r, c, nc_ds, "aph_443_qaa"),
-                "aph_490_qaa": self.get_product(r, c, nc_ds, "aph_490_qaa"),
-                "aph_529_qaa": self.get_product(r, c, nc_ds, "aph_529_qaa"),
-                "aph_566_qaa": self.get_product(r, c, nc_ds, "aph_566_qaa"),
-                "aph_672_qaa": self.get_product(r, c, nc_ds, "aph_672_qaa"),
-                "chlor_a": self.get_product(r, c, nc_ds, "chlor_a"),
-                "l2_flags": self.get_product(r, c, nc_ds, "l2_flags"),
-                "in_situ_lat": row["lat"],
-                "in_situ_lon": row["lon"],
-                "Global_ID": row["Global_ID"],
-                "Date": row["Date"],
-                "l1b_gportal_id": row["l1b_gportal_id"],
-                "MATCHUP_VALID": is_valid
-            }
-            
-            out_df.loc[n] = l2
-            n += 1
-            if n % 10 == 0:
-                out_df.to_csv(self.out_file)
-        out_df.to_csv(self.out_file)
+        rows = range(start_index, in_df.shape[0])
+        ordered = OrderedRows(rows)
+        if workers > 1:
+            # files are spread over worker processes, results come back as they finish
+            results = run_parallel(self, in_df, rows, self.group_key, workers)
+        else:
+            if grouped:
+                # all stations of a file are extracted while it is open, the output keeps the csv order
+                rows = group_rows(rows, lambda i: self.group_key(in_df.iloc[i]))
+            results = run_serial(self, in_df, rows)
+        try:
+            for i, result, error in results:
+                self.record_row(i, in_df.iloc[i], result, error)
+                for l2, is_valid in ordered.add(i, result):
+                    if is_valid:
+                        vld += 1
+                    else:
+                        invld += 1
+                    writer.write(l2)
+                writer.commit(ordered.next_index())
+        finally:
+            writer.close()
         print("VALID", vld, "INVALID", invld)
 
 # in_csv = "/home/muhammad/process_sgli/output_no_rrs.csv"
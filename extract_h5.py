@@ -3,11 +3,25 @@ import h5py
 import pandas as pd
 import os
 from pathlib import Path
+from geolocation import GeoIndex, IndexCache
+from grouping import group_rows, OrderedRows
+from parallel import run_serial, run_parallel
+from output import open_writer
+from flags import get_table
+from validity import validity_map
 COLUMNS = ["MATCHUP_VALID", 'lat', 'lon', 'Rrs_380', 'Rrs_412', 'Rrs_443', 'Rrs_490', 'Rrs_530', 'Rrs_565', 'Rrs_672', 'AOD_380', 'AOD_412', 'AOD_443', 'AOD_490', 'AOD_530', 'AOD_565', 'AOD_672', 'adg_380', 'adg_412', 'adg_443', 'adg_490', 'adg_530', 'adg_565', 'adg_672', 'ap_380', 'ap_412', 'ap_443', 'ap_490', 'ap_530', 'ap_565', 'ap_672', 'aph_380', 'aph_412', 'aph_443', 'aph_490', 'aph_530', 'aph_565', 'aph_672', 'bbp_380', 'bbp_412', 'bbp_443', 'bbp_490', 'bbp_530', 'bbp_565', 'bbp_672', 'bp_380', 'bp_412', 'bp_443', 'bp_490', 'bp_530', 'bp_565', 'bp_672', 'Chla_oci', 'Chla_yoc', 'TSM_yoc', 'l2_flags', 'in_situ_lat', 'in_situ_lon', 'Global_ID', 'Date', 'l1b_gportal_id']
+# parquet column types, every band is float32
+TYPES = dict.fromkeys(COLUMNS, "float32")
+TYPES.update({"MATCHUP_VALID": "bool", "l2_flags": "uint32", "in_situ_lat": "float64", "in_situ_lon": "float64",
+              "Global_ID": "string", "Date": "string", "l1b_gportal_id": "string"})
 class OCSMARTExtractor:
-    def __init__(self, input_csv, output_csv):
+    def __init__(self, input_csv, output_csv, catalog=None):
         self.out_file = Path(output_csv)
         self.input_csv = Path(input_csv)
+        # optional catalog.Catalog, rows are tracked under the "extract_ocsmart" stage
+        self.catalog = catalog
+        self.indexes = IndexCache()
+        self.flags = get_table("ocsmart")
 
     def get_h5_file(self, path):
         print("reading file: %s" % path)
@@ -19,16 +33,6 @@ class OCSMARTExtractor:
         lon = h5["Longitude"][:]
         return lat, lon
 
-    def distance_sqr(self, lat, df_lat, lon, df_lon):
-        lat_diff = (df_lat - lat)
-        lon_diff = (df_lon - lon)
-        return lat_diff * lat_diff + lon_diff * lon_diff
-
-    def find_entry(self, lat_mat, lon_mat, lat, lon):
-        dist = self.distance_sqr(lat, lat_mat, lon, lon_mat)
-        row, col = np.where(dist == np.min(dist))
-        return row, col, dist[row, col]
-    
     def get_product(self, row, column, h5, product_name, group=None):
         if group == None:
             p = h5[product_name][:]
@@ -37,17 +41,14 @@ class OCSMARTExtractor:
         return p[row, column]
     
     def validate_p(self, value):
-        return value == 0
+        return self.flags.valid(value)
     
     def validate_matchup(self, row, column, h5file):
         print(" r, c", row, column)
         flgs = h5file["L2_flags"][:][row-1: row+2, column-1:column+2]
-        vld = []
-        for i in range(3):
-            vld.append([])
-            for j in range(3):
-                vld[i].append(self.validate_p(flgs[i, j]))
-        vld = np.array(vld,dtype=np.bool)
+        if flgs.shape != (3, 3):
+            return False
+        vld = self.flags.valid(flgs)
         if vld[1, 1] == False: return False
         n_vld = np.sum(vld)
         if n_vld < 5: return False
@@ -56,107 +57,152 @@ class OCSMARTExtractor:
         if cv > 0.15: return False
         return True
 
-    def start(self, start_index=0):
+    def matchup_map(self, h5file, window=None, size=3):
+        # validate_matchup for every pixel of the scene, or of a (r0, r1, c0, c1) window
+        r0, r1, c0, c1 = window or (0, None, 0, None)
+        flgs = h5file["L2_flags"][r0:r1, c0:c1]
+        rrs_443 = h5file["Rrs"]["Rrs_443nm"][r0:r1, c0:c1]
+        return validity_map(self.flags.valid(flgs), rrs_443, size)
+
+    def product_paths(self, row):
+        vnr_id = row["l1b_gportal_id"]
+        product_id = vnr_id + "_ocsmart_" + str(row["Global_ID"])
+        h5_path = "/home/shared/Data/SGLI/ocsmart_processed/" + product_id + ".h5"
+        return product_id, h5_path
+
+    def open_granules(self, path):
+        return (self.get_h5_file(path),)
+
+    def group_key(self, row):
+        if type(row["l1b_gportal_id"]) != str:
+            return None
+        return self.product_paths(row)[1]
+
+    def process_row(self, row, granules):
+        if type(row["l1b_gportal_id"]) != str:
+            return None
+        h5_path = self.product_paths(row)[1]
+        h5, = granules.get(h5_path, h5_path)
+        # stations sharing a file reuse its index
+        index = self.indexes.get(h5_path, lambda: GeoIndex(*self.get_lat_lon_data(h5)))
+        r, c, d = index.query(row["lat"], row["lon"])
+        lat_mat, lon_mat = index.lat, index.lon
+        print("found entry at %d and %d with dist = %f km"%(r, c, d))
+        try:
+            is_valid = self.validate_matchup(r, c, h5)
+        except:
+            is_valid = False
+        if not is_valid:
+            print("invalid matchup")
+        else:
+            print("VALID!")
+        l2 = {
+            "lat": lat_mat[r, c],
+            "lon": lon_mat[r, c],
+            "Rrs_380": self.get_product(r, c, h5, "Rrs_380nm", "Rrs"),
+            "Rrs_412": self.get_product(r, c, h5, "Rrs_412nm", "Rrs"),
+            "Rrs_443": self.get_product(r, c, h5, "Rrs_443nm", "Rrs"),
+            "Rrs_490": self.get_product(r, c, h5, "Rrs_490nm", "Rrs"),
+            "Rrs_530": self.get_product(r, c, h5, "Rrs_530nm", "Rrs"),
+            "Rrs_565": self.get_product(r, c, h5, "Rrs_565nm", "Rrs"),
+            "Rrs_672": self.get_product(r, c, h5, "Rrs_672nm", "Rrs"),
+            "AOD_380": self.get_product(r, c, h5, "AOD_380nm", "AOD"),
+            "AOD_412": self.get_product(r, c, h5, "AOD_412nm", "AOD"),
+            "AOD_443": self.get_product(r, c, h5, "AOD_443nm", "AOD"),
+            "AOD_490": self.get_product(r, c, h5, "AOD_490nm", "AOD"),
+            "AOD_530": self.get_product(r, c, h5, "AOD_530nm", "AOD"),
+            "AOD_565": self.get_product(r, c, h5, "AOD_565nm", "AOD"),
+            "AOD_672": self.get_product(r, c, h5, "AOD_672nm", "AOD"),
+            "adg_380": self.get_product(r, c, h5, "adg_380nm", "adg"),
+            "adg_412": self.get_product(r, c, h5, "adg_412nm", "adg"),
+            "adg_443": self.get_product(r, c, h5, "adg_443nm", "adg"),
+            "adg_490": self.get_product(r, c, h5, "adg_490nm", "adg"),
+            "adg_530": self.get_product(r, c, h5, "adg_530nm", "adg"),
+            "adg_565": self.get_product(r, c, h5, "adg_565nm", "adg"),
+            "adg_672": self.get_product(r, c, h5, "adg_672nm", "adg"),
+            "ap_380": self.get_product(r, c, h5, "ap_380nm", "ap"),
+            "ap_412": self.get_product(r, c, h5, "ap_412nm", "ap"),
+            "ap_443": self.get_product(r, c, h5, "ap_443nm", "ap"),
+            "ap_490": self.get_product(r, c, h5, "ap_490nm", "ap"),
+            "ap_530": self.get_product(r, c, h5, "ap_530nm", "ap"),
+            "ap_565": self.get_product(r, c, h5, "ap_565nm", "ap"),
+            "ap_672": self.get_product(r, c, h5, "ap_672nm", "ap"),
+            "aph_380": self.get_product(r, c, h5, "aph_380nm", "aph"),
+            "aph_412": self.get_product(r, c, h5, "aph_412nm", "aph"),
+            "aph_443": self.get_product(r, c, h5, "aph_443nm", "aph"),
+            "aph_490": self.get_product(r, c, h5, "aph_490nm", "aph"),
+            "aph_530": self.get_product(r, c, h5, "aph_530nm", "aph"),
+            "aph_565": self.get_product(r, c, h5, "aph_565nm", "aph"),
+            "aph_672": self.get_product(r, c, h5, "aph_672nm", "aph"),
+            "bbp_380": self.get_product(r, c, h5, "bbp_380nm", "bbp"),
+            "bbp_412": self.get_product(r, c, h5, "bbp_412nm", "bbp"),
+            "bbp_443": self.get_product(r, c, h5, "bbp_443nm", "bbp"),
+            "bbp_490": self.get_product(r, c, h5, "bbp_490nm", "bbp"),
+            "bbp_530": self.get_product(r, c, h5, "bbp_530nm", "bbp"),
+            "bbp_565": self.get_product(r, c, h5, "bbp_565nm", "bbp"),
+            "bbp_672": self.get_product(r, c, h5, "bbp_672nm", "bbp"),
+            "bp_380": self.get_product(r, c, h5, "bp_380nm", "bp"),
+            "bp_412": self.get_product(r, c, h5, "bp_412nm", "bp"),
+            "bp_443": self.get_product(r, c, h5, "bp_443nm", "bp"),
+            "bp_490": self.get_product(r, c, h5, "bp_490nm", "bp"),
+            "bp_530": self.get_product(r, c, h5, "bp_530nm", "bp"),
+            "bp_565": self.get_product(r, c, h5, "bp_565nm", "bp"),
+            "bp_672": self.get_product(r, c, h5, "bp_672nm", "bp"),
+            "Chla_oci": self.get_product(r, c, h5, "chlor_a(oci)"),
+            "Chla_yoc": self.get_product(r, c, h5, "chlor_a(yoc)"),
+            "TSM_yoc": self.get_product(r, c, h5, "tsm(yoc)"),
+            "l2_flags": self.get_product(r, c, h5, "L2_flags"),
+            "in_situ_lat": row["lat"],
+            "in_situ_lon": row["lon"],
+            "Global_ID": row["Global_ID"],
+            "Date": row["Date"],
+            "l1b_gportal_id": row["l1b_gportal_id"],
+            "MATCHUP_VALID": is_valid
+        }
+        return l2, is_valid
+
+    def record_row(self, i, row, result, error):
+        if type(row["l1b_gportal_id"]) != str:
+            return
+        product_id = self.product_paths(row)[0]
+        if error is not None:
+            print("row %d failed: %s" % (i, error))
+            if self.catalog is not None:
+                self.catalog.set_state(product_id, "failed", stage="extract_ocsmart", error=error)
+        elif result is not None and self.catalog is not None:
+            self.catalog.set_state(product_id, "processed", stage="extract_ocsmart", path=self.out_file)
+
+    def start(self, start_index=None, grouped=False, workers=1, sync_every=10, output="csv"):
         in_df = pd.read_csv(self.input_csv)
         print(len(in_df))
-        out_df = pd.DataFrame(columns=COLUMNS)
-        n = 0
+        # with no start_index the previous run resumes at its last checkpoint
+        # output="parquet" writes a typed part directory at out_file instead of a csv
+        writer = open_writer(self.out_file, COLUMNS, TYPES, output, sync_every)
+        start_index = writer.open(start_index)
         vld = 0
         invld = 0
-        for i in range(start_index, in_df.shape[0]):
-            row = in_df.iloc[i]
-            print("processing file #: ", i)
-            if type(row["l1b_gportal_id"]) != str:
-                continue
-            vnr_id = row["l1b_gportal_id"]
-            h5_path = "/home/shared/Data/SGLI/ocsmart_processed/" + vnr_id + "_ocsmart_" + str(row["Global_ID"]) + ".h5"
-            try:
-                h5 = self.get_h5_file(h5_path)
-            except:
-                continue
-            lat_mat, lon_mat = self.get_lat_lon_data(h5)
-            r, c, d = self.find_entry(lat_mat, lon_mat, row["lat"], row["lon"])
-            r = r[0]
-            c = c[0]
-            print("found entry at %d and %d with dist = %f"%(r, c, d))
-            try:
-                is_valid = self.validate_matchup(r, c, h5)
-            except:
-                is_valid = False
-            if not is_valid:
-                print("invalid matchup")
-                invld += 1
-            else:
-                print("VALID!")
-                vld += 1
-            l2 = {
-                "lat": lat_mat[r, c],
-                "lon": lon_mat[r, c],
-                "Rrs_380": self.get_product(r, c, h5, "Rrs_380nm", "Rrs"),
-                "Rrs_412": self.get_product(r, c, h5, "Rrs_412nm", "Rrs"),
-                "Rrs_443": self.get_product(r, c, h5, "Rrs_443nm", "Rrs"),
-                "Rrs_490": self.get_product(r, c, h5, "Rrs_490nm", "Rrs"),
-                "Rrs_530": self.get_product(r, c, h5, "Rrs_530nm", "Rrs"),
-                "Rrs_565": self.get_product(r, c, h5, "Rrs_565nm", "Rrs"),
-                "Rrs_672": self.get_product(r, c, h5, "Rrs_672nm", "Rrs"),
-                "AOD_380": self.get_product(r, c, h5, "AOD_380nm", "AOD"),
-                "AOD_412": self.get_product(r, c, h5, "AOD_412nm", "AOD"),
-                "AOD_443": self.get_product(r, c, h5, "AOD_443nm", "AOD"),
-                "AOD_490": self.get_product(r, c, h5, "AOD_490nm", "AOD"),
-                "AOD_530": self.get_product(r, c, h5, "AOD_530nm", "AOD"),
-                "AOD_565": self.get_product(r, c, h5, "AOD_565nm", "AOD"),
-                "AOD_672": self.get_product(r, c, h5, "AOD_672nm", "AOD"),
-                "adg_380": self.get_product(r, c, h5, "adg_380nm", "adg"),
-                "adg_412": self.get_product(r, c, h5, "adg_412nm", "adg"),
-                "adg_443": self.get_product(r, c, h5, "adg_443nm", "adg"),
-                "adg_490": self.get_product(r, c, h5, "adg_490nm", "adg"),
-                "adg_530": self.get_product(r, c, h5, "adg_530nm", "adg"),
-                "adg_565": self.get_product(r, c, h5, "adg_565nm", "adg"),
-                "adg_672": self.get_product(r, c, h5, "adg_672nm", "adg"),
-                "ap_380": self.get_product(r, c, h5, "ap_380nm", "ap"),
-                "ap_412": self.get_product(r, c, h5, "ap_412nm", "ap"),
-                "ap_443": self.get_product(r, c, h5, "ap_443nm", "ap"),
-                "ap_490": self.get_product(r, c, h5, "ap_490nm", "ap"),
-                "ap_530": self.get_product(r, c, h5, "ap_530nm", "ap"),
-                "ap_565": self.get_product(r, c, h5, "ap_565nm", "ap"),
-                "ap_672": self.get_product(r, c, h5, "ap_672nm", "ap"),
-                "aph_380": self.get_product(r, c, h5, "aph_380nm", "aph"),
-                "aph_412": self.get_product(r, c, h5, "aph_412nm", "aph"),
-                "aph_443": self.get_product(r, c, h5, "aph_443nm", "aph"),
-                "aph_490": self.get_product(r, c, h5, "aph_490nm", "aph"),
-                "aph_530": self.get_product(r, c, h5, "aph_530nm", "aph"),
-                "aph_565": self.get_product(r, c, h5, "aph_565nm", "aph"),
-                "aph_672": self.get_product(r, c, h5, "aph_672nm", "aph"),
-                "bbp_380": self.get_product(r, c, h5, "bbp_380nm", "bbp"),
-                "bbp_412": self.get_product(r, c, h5, "bbp_412nm", "bbp"),
-                "bbp_443": self.get_product(r, c, h5, "bbp_443nm", "bbp"),
-                "bbp_490": self.get_product(r, c, h5, "bbp_490nm", "bbp"),
-                "bbp_530": self.get_product(r, c, h5, "bbp_530nm", "bbp"),
-                "bbp_565": self.get_product(r, c, h5, "bbp_565nm", "bbp"),
-                "bbp_672": self.get_product(r, c, h5, "bbp_672nm", "bbp"),
-                "bp_380": self.get_product(r, c, h5, "bp_380nm", "bp"),
-                "bp_412": self.get_product(r, c, h5, "bp_412nm", "bp"),
-                "bp_443": self.get_product(r, c, h5, "bp_443nm", "bp"),
-                "bp_490": self.get_product(r, c, h5, "bp_490nm", "bp"),
-                "bp_530": self.get_product(r, c, h5, "bp_530nm", "bp"),
-                "bp_565": self.get_product(r, c, h5, "bp_565nm", "bp"),
-                "bp_672": self.get_product(r, c, h5, "bp_672nm", "bp"),
-                "Chla_oci": self.get_product(r, c, h5, "chlor_a(oci)"),
-                "Chla_yoc": self.get_product(r, c, h5, "chlor_a(yoc)"),
-                "TSM_yoc": self.get_product(r, c, h5, "tsm(yoc)"),
-                "l2_flags": self.get_product(r, c, h5, "L2_flags"),
-                "in_situ_lat": row["lat"],
-                "in_situ_lon": row["lon"],
-                "Global_ID": row["Global_ID"],
-                "Date": row["Date"],
-                "l1b_gportal_id": row["l1b_gportal_id"],
-                "MATCHUP_VALID": is_valid
-            }
-            out_df.loc[n] = l2
-            n += 1
-            if n % 10 == 0:
-                out_df.to_csv(self.out_file)
-        out_df.to_csv(self.out_file)
+        rows = range(start_index, in_df.shape[0])
+        ordered = OrderedRows(rows)
+        if workers > 1:
+            # files are spread over worker processes, results come back as they finish
+            results = run_parallel(self, in_df, rows, self.group_key, workers)
+        else:
+            if grouped:
+                # all stations of a file are extracted while it is open, the output keeps the csv order
+                rows = group_rows(rows, lambda i: self.group_key(in_df.iloc[i]))
+            results = run_serial(self, in_df, rows)
+        try:
+            for i, result, error in results:
+                self.record_row(i, in_df.iloc[i], result, error)
+                for l2, is_valid in ordered.add(i, result):
+                    if is_valid:
+                        vld += 1
+                    else:
+                        invld += 1
+                    writer.write(l2)
+                writer.commit(ordered.next_index())
+        finally:
+            writer.close()
         print("VALID", vld, "INVALID", invld)
 
 # in_csv = ["/home/muhammad/process_sgli/output_train.csv", "/home/muhammad/process_sgli/output_test.csv", "/home/muhammad/process_sgli/output_no_rrs.csv"]
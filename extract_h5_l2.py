@@ -9,6 +9,13 @@ import numpy as np
 import pandas as pd
 from pathlib import Path
 from download import Download
+from remote import RemoteFile
+from geolocation import TiePointLocator, IndexCache, great_circle
+from grouping import group_rows, OrderedRows
+from parallel import run_serial, run_parallel
+from output import open_writer
+from flags import get_table
+from validity import validity_map
 
 
 """
@@ -40,72 +47,90 @@ COLUMNS = [
             "ag_443",
             "MATCHUP_VALID"
         ]
+# parquet column types
+TYPES = dict.fromkeys(COLUMNS, "float32")
+TYPES.update({"Global_ID": "string", "lat": "float64", "lon": "float64", "Date": "string", "l1b_gportal_id": "string",
+              "l2_rrs_gportal_id": "string", "l2_prod_gportal_id": "string", "Rrs_flags": "uint16",
+              "prod_flags": "uint16", "MATCHUP_VALID": "bool"})
 
-FLAGS = ['NODATA', 'LAND', 'ATMFAIL', 'CLDICE', 'CLDICEWARN', 'STRAYLIGHT', 'HIGLINT', 'MODGLINT', 'HISOLZEN', 'HIAIRSOLTHK', 'LOWLW', 'TURBIDW', 'SHALLOW', 'CDOMFAIL', 'CHLFAIL']
-INVALID = ["ATMFAIL", "LAND", "HIGLINT", "STRAYLIGHT", "CLDICE", "NODATA"]
 class SGLIL2Extractor:
-    def __init__(self, input_csv, output_csv):
+    def __init__(self, input_csv, output_csv, catalog=None, remote=None, cache=None):
         self.out_file = Path(output_csv)
         self.in_file = Path(input_csv)
+        # optional catalog.Catalog, rows are tracked under the "extract_l2" stage
+        self.catalog = catalog
+        # optional authenticated Download, granules are then read in place on
+        # G-Portal through range requests instead of from sgli-lvl2
+        self.remote = remote
+        # optional cache.GranuleCache over sgli-lvl2, queued rows pin their granules
+        self.cache = cache
+        self.locators = IndexCache()
+        self.flags = get_table("sgli")
 
         
     def get_h5_file(self, path):
         print("reading file: %s" % path)
+        if self.cache is not None:
+            self.cache.touch(path)
         f = h5py.File(path, 'r')
         return f
 
-    def DN_to_Reflectance_L2(self, h5_file, prod_name):
-        # Get Rrs data
-        real_prod_name = prod_name.replace('Rrs', 'NWLR')
-        dset = h5_file['Image_data/' + real_prod_name]
+    def get_remote_h5_file(self, link):
+        print("reading remote file: %s" % link)
+        f = h5py.File(RemoteFile(self.remote, link), 'r')
+        return f
 
+    def calibrate(self, dset, data, slope_name, offset_name):
         # Validate
-        data = dset[:].astype(np.float32)
+        data = data.astype(np.float32)
         if 'Error_DN' in dset.attrs:
-            data[data == dset.attrs['Error_DN'][0]] = np.NaN
-        with np.warnings.catch_warnings():
-            np.warnings.filterwarnings(
-                'ignore', r'invalid value encountered in (greater|less)')
+            data[data == dset.attrs['Error_DN'][0]] = np.nan
+        with np.errstate(invalid='ignore'):
             if 'Maximum_valid_DN' in dset.attrs:
-                data[data > dset.attrs['Maximum_valid_DN'][0]] = np.NaN
+                data[data > dset.attrs['Maximum_valid_DN'][0]] = np.nan
             if 'Minimum_valid_DN' in dset.attrs:
-                data[data < dset.attrs['Minimum_valid_DN'][0]] = np.NaN
+                data[data < dset.attrs['Minimum_valid_DN'][0]] = np.nan
 
         # Convert DN to physical value
-        Slope = dset.attrs['Rrs_slope'][0]
-        Offset = dset.attrs['Rrs_offset'][0]
-        data = data * Slope + Offset
+        Slope = dset.attrs[slope_name][0]
+        Offset = dset.attrs[offset_name][0]
+        return data * Slope + Offset, Slope, Offset
+
+    def read(self, dset, window=None):
+        # window is (r0, r1, c0, c1), only that block is read from the file
+        if window is None:
+            return dset[:]
+        r0, r1, c0, c1 = window
+        return dset[r0:r1, c0:c1]
+
+    def DN_to_Reflectance_L2(self, h5_file, prod_name, window=None):
+        # Get Rrs data
+        real_prod_name = prod_name.replace('Rrs', 'NWLR')
+        dset = h5_file['Image_data/' + real_prod_name]
+
+        data, Slope, Offset = self.calibrate(dset, self.read(dset, window), 'Rrs_slope', 'Rrs_offset')
         print("Band: ", prod_name, " >> Slope= ", Slope, " Offset= ", Offset)
 
         return data
 
-    def get_product_data(self, h5_file, prod_name):
+    def get_product_data(self, h5_file, prod_name, window=None):
         dset = h5_file['Image_data/' + prod_name]
 
         # Return uint16 type data if the product is QA_flag or Line_tai93
         if 'QA_flag' == prod_name or 'Line_tai93' == prod_name:
-            return dset[:]
+            return self.read(dset, window)
 
-        # Validate
-        data = dset[:].astype(np.float32)
-        if 'Error_DN' in dset.attrs:
-            data[data == dset.attrs['Error_DN'][0]] = np.NaN
-        with np.warnings.catch_warnings():
-            np.warnings.filterwarnings(
-                'ignore', r'invalid value encountered in (greater|less)')
-            if 'Maximum_valid_DN' in dset.attrs:
-                data[data > dset.attrs['Maximum_valid_DN'][0]] = np.NaN
-            if 'Minimum_valid_DN' in dset.attrs:
-                data[data < dset.attrs['Minimum_valid_DN'][0]] = np.NaN
-
-        # Convert DN to physical value
-        Slope = dset.attrs['Slope'][0]
-        Offset = dset.attrs['Offset'][0]
-        data = data * Slope + Offset
+        data, Slope, Offset = self.calibrate(dset, self.read(dset, window), 'Slope', 'Offset')
         print("Band: ", prod_name, " >> Slope= ", Slope, " Offset= ", Offset)
 
         return data
 
+    def get_window(self, h5_file, row, column, half=1):
+        # the (2 * half + 1)^2 block around row, column, clipped to the scene
+        n_lin, n_pix = h5_file['Image_data/QA_flag'].shape
+        return (max(row - half, 0), min(row + half + 1, n_lin),
+                max(column - half, 0), min(column + half + 1, n_pix))
+
     # lon_mode is False if not given
     def bilin_2d(self, data: np.ndarray, interval: int, lon_mode=False):
         data = data.copy()
@@ -177,65 +202,68 @@ class SGLIL2Extractor:
 
         return data
 
+    def get_locator(self, h5_file):
+        # searches the tie-point grids, get_geometry_data would upsample the whole scene
+        lat = h5_file['Geometry_data/Latitude']
+        lon = h5_file['Geometry_data/Longitude']
+        img_attrs = h5_file['Image_data'].attrs
+        return TiePointLocator(lat[:], lon[:], lat.attrs['Resampling_interval'][0],
+                               img_attrs['Number_of_lines'][0], img_attrs['Number_of_pixels'][0])
+
     def HH_to_HHMMSS(self, data_HH):
         HH = data_HH.astype(int)
         MM = ((data_HH*60) % 60).astype(int)
         SS = ((data_HH*3600) % 60).astype(int)
         return (HH, MM, SS)
 
-    def distance_sqr(self, lat, df_lat, lon, df_lon):
-        lat_diff = (df_lat - lat)
-        lon_diff = (df_lon - lon)
-        return lat_diff * lat_diff + lon_diff * lon_diff
-
-    def find_entry(self, lat_mat, lon_mat, lat, lon):
-        dist = self.distance_sqr(lat, lat_mat, lon, lon_mat)
-        row, col = np.where(dist == np.min(dist))
-        return row, col, dist[row, col]
-    
     def get_p_flags(self, value):
-        f = []
-        order = 0
-        while value > 0:
-            rem = value % 2
-            value //= 2
-            if rem:
-                f.append(FLAGS[order])
-            order += 1
-        return f
+        return self.flags.decode(value)
+
     def validate_p(self, value):
-        f = self.get_p_flags(value)
-        return np.intersect1d(f, INVALID).shape[0] == 0
-    
-    def validate_matchup(self, row, column, h5_rrs):
+        return self.flags.valid(value)
+
+    def validate_matchup(self, row, column, h5_rrs, window=None, rrs_443=None):
         print(" r, c", row, column)
-        flgs = h5_rrs["Image_data"]["QA_flag"][:][row-1: row+2, column-1:column+2]
-        vld = []
-        for i in range(3):
-            vld.append([])
-            for j in range(3):
-                vld[i].append(self.validate_p(flgs[i, j]))
-        vld = np.array(vld,dtype=np.bool)
+        if window is None:
+            window = self.get_window(h5_rrs, row, column)
+        r0, r1, c0, c1 = window
+        # a window cut by the scene edge is never a valid matchup
+        if (r0, r1, c0, c1) != (row - 1, row + 2, column - 1, column + 2):
+            return False
+        flgs = self.get_product_data(h5_rrs, 'QA_flag', window)
+        vld = self.flags.valid(flgs)
         if vld[1, 1] == False: return False
         n_vld = np.sum(vld)
         if n_vld < 5: return False
-        rrs_443 = self.DN_to_Reflectance_L2(h5_rrs, 'Rrs_443')[row-1: row+2, column-1:column+2]
+        if rrs_443 is None:
+            rrs_443 = self.DN_to_Reflectance_L2(h5_rrs, 'Rrs_443', window)
         cv = rrs_443.std()/rrs_443.mean()
         if cv > 0.15: return False
         return True
 
+    def matchup_map(self, h5_rrs, window=None, size=3):
+        # validate_matchup for every pixel of the scene, or of a (r0, r1, c0, c1) window
+        flgs = self.get_product_data(h5_rrs, 'QA_flag', window)
+        rrs_443 = self.DN_to_Reflectance_L2(h5_rrs, 'Rrs_443', window)
+        return validity_map(self.flags.valid(flgs), rrs_443, size)
+
     def get_p_data(self, row, rrs_h5, prod_h5):
         lat = row['lat']
         lon = row['lon']
-        lat_mat = self.get_geometry_data(rrs_h5, "Latitude")
-        lon_mat = self.get_geometry_data(rrs_h5, "Longitude")
         print("finding entry ..")
-        r, c, d = self.find_entry(lat_mat, lon_mat, lat, lon)
-        r = r[0]
-        c = c[0]
-        print("found matching point at %d, %d with distance^2 = %f" % (r, c, d))
+        # rows sharing a granule reuse its locator
+        locator = self.locators.get(row["l2_rrs_gportal_id"], lambda: self.get_locator(rrs_h5))
+        r, c, d = locator.find(lat, lon)
+        print("found matching point at %d, %d with distance^2 = %f (%f km)" % (
+            r, c, d, great_circle(lat, lon, *locator.pixel(r, c))))
+        # every band is read and calibrated for the 3x3 window only, never the scene
+        window = self.get_window(rrs_h5, r, c)
+        r0, _, c0, _ = window
+        rrs = {}
+        for band in ["Rrs_380", "Rrs_412", "Rrs_443", "Rrs_490", "Rrs_530", "Rrs_565", "Rrs_670"]:
+            rrs[band] = self.DN_to_Reflectance_L2(rrs_h5, band, window)
         try:
-            is_valid = self.validate_matchup(r, c, rrs_h5)
+            is_valid = self.validate_matchup(r, c, rrs_h5, window, rrs["Rrs_443"])
         except:
             is_valid = False
 
@@ -248,52 +276,97 @@ class SGLIL2Extractor:
             "l1b_gportal_id": row["l1b_gportal_id"],
             "l2_rrs_gportal_id": row["l2_rrs_gportal_id"],
             "l2_prod_gportal_id": row["l2_prod_gportal_id"],
-            "Rrs_380": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_380")[r, c],
-            "Rrs_412": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_412")[r, c],
-            "Rrs_443": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_443")[r, c],
-            "Rrs_490": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_490")[r, c],
-            "Rrs_530": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_530")[r, c],
-            "Rrs_565": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_565")[r, c],
-            "Rrs_670": self.DN_to_Reflectance_L2(rrs_h5, "Rrs_670")[r, c],
+            "Rrs_380": rrs["Rrs_380"][r - r0, c - c0],
+            "Rrs_412": rrs["Rrs_412"][r - r0, c - c0],
+            "Rrs_443": rrs["Rrs_443"][r - r0, c - c0],
+            "Rrs_490": rrs["Rrs_490"][r - r0, c - c0],
+            "Rrs_530": rrs["Rrs_530"][r - r0, c - c0],
+            "Rrs_565": rrs["Rrs_565"][r - r0, c - c0],
+            "Rrs_670": rrs["Rrs_670"][r - r0, c - c0],
             "Rrs_765": np.nan,
             "Rrs_flags": rrs_h5["Image_data"]["QA_flag"][r, c],
             "prod_flags": prod_h5["Image_data"]["QA_flag"][r, c],
-            "Chla": self.get_product_data(prod_h5, 'CHLA')[r, c],
-            "TSM": self.get_product_data(prod_h5, 'TSM'),
-            "ag_443": self.get_product_data(prod_h5, 'CDOM'),
+            "Chla": self.get_product_data(prod_h5, 'CHLA', (r, r + 1, c, c + 1))[0, 0],
+            "TSM": self.get_product_data(prod_h5, 'TSM', (r, r + 1, c, c + 1))[0, 0],
+            "ag_443": self.get_product_data(prod_h5, 'CDOM', (r, r + 1, c, c + 1))[0, 0],
             "MATCHUP_VALID": is_valid
         }, is_valid
 
-    def start(self, from_index=0):
+    def granule_paths(self, row):
+        rrs_id = str(row["l2_rrs_gportal_id"])
+        prod_id = str(row["l2_prod_gportal_id"])
+        if rrs_id == 'nan' or prod_id == 'nan':
+            return []
+        return ["/home/shared/Data/SGLI/sgli-lvl2/" + rrs_id + ".h5",
+                "/home/shared/Data/SGLI/sgli-lvl2/" + prod_id + ".h5"]
+
+    def done_with_row(self, row):
+        for path in self.granule_paths(row):
+            self.cache.unpin(path, "extract_l2")
+            self.cache.release(path)
+
+    def granule_key(self, row):
+        return str(row["l2_rrs_gportal_id"]), str(row["l2_prod_gportal_id"])
+
+    def open_granules(self, row):
+        if self.remote is not None:
+            return (self.get_remote_h5_file(row["l2_rrs_gportal_link"]),
+                    self.get_remote_h5_file(row["l2_prod_gportal_link"]))
+        rrs_h5_path, prod_h5_path = self.granule_paths(row)
+        return self.get_h5_file(rrs_h5_path), self.get_h5_file(prod_h5_path)
+
+    def process_row(self, row, granules):
+        rrs_id, prod_id = self.granule_key(row)
+        if rrs_id == 'nan' or prod_id == 'nan':
+            return None
+        rrs_h5, prod_h5 = granules.get((rrs_id, prod_id), row)
+        return self.get_p_data(row, rrs_h5, prod_h5)
+
+    def record_row(self, i, row, result, error):
+        product_id = str(row["l2_rrs_gportal_id"]) + "_" + str(row["Global_ID"])
+        if error is not None:
+            print("row %d failed: %s" % (i, error))
+            if self.catalog is not None:
+                self.catalog.set_state(product_id, "failed", stage="extract_l2", error=error)
+        elif result is not None and self.catalog is not None:
+            self.catalog.set_state(product_id, "processed", stage="extract_l2", path=self.out_file)
+
+    def start(self, from_index=None, grouped=False, workers=1, sync_every=10, output="csv"):
         in_df = pd.read_csv(self.in_file)
         print(len(in_df))
-        out_df = pd.DataFrame(columns=COLUMNS)
-        n = 0
+        # with no from_index the previous run resumes at its last checkpoint
+        # output="parquet" writes a typed part directory at out_file instead of a csv
+        writer = open_writer(self.out_file, COLUMNS, TYPES, output, sync_every)
+        from_index = writer.open(from_index)
+        if self.cache is not None:
+            for i in range(from_index, len(in_df)):
+                for path in self.granule_paths(in_df.iloc[i]):
+                    self.cache.pin(path, "extract_l2")
         vld = 0
         invld = 0
-        for i in range(from_index, len(in_df)):
-            print("processing row # %d" % i)
-            row = in_df.iloc[i]
-            rrs_id = str(row["l2_rrs_gportal_id"])
-            prod_id = str(row["l2_prod_gportal_id"])
-            if rrs_id == 'nan' or prod_id == 'nan':
-                continue
-            rrs_h5_path = "/home/shared/Data/SGLI/sgli-lvl2/" + rrs_id + ".h5"
-            prod_h5_path = "/home/shared/Data/SGLI/sgli-lvl2/" + prod_id + ".h5"
-            try:
-                rrs_h5 = self.get_h5_file(rrs_h5_path)
-                prod_h5 = self.get_h5_file(prod_h5_path)
-            except:
-                continue
-            pixel, is_valid = self.get_p_data(row, rrs_h5, prod_h5)
-            if is_valid:
-                vld += 1
-            else:
-                invld += 1
-
-            out_df.loc[n] = pixel
-            n += 1
-            if n % 10 == 0:
-                out_df.to_csv(self.out_file)
-        out_df.to_csv(self.out_file)
+        rows = range(from_index, len(in_df))
+        ordered = OrderedRows(rows)
+        if workers > 1:
+            # granules are spread over worker processes, results come back as they finish
+            results = run_parallel(self, in_df, rows, self.granule_key, workers)
+        else:
+            if grouped:
+                # all stations of a granule are extracted while it is open, the output keeps the csv order
+                rows = group_rows(rows, lambda i: self.granule_key(in_df.iloc[i]))
+            results = run_serial(self, in_df, rows)
+        try:
+            for i, result, error in results:
+                row = in_df.iloc[i]
+                if self.cache is not None:
+                    self.done_with_row(row)
+                self.record_row(i, row, result, error)
+                for pixel, is_valid in ordered.add(i, result):
+                    if is_valid:
+                        vld += 1
+                    else:
+                        invld += 1
+                    writer.write(pixel)
+                writer.commit(ordered.next_index())
+        finally:
+            writer.close()
         print("VALID", vld, "INVALID", invld)
@@ -0,0 +1,75 @@
+import numpy as np
+
+
+class FlagTable:
+    """
+    A QA/l2_flags bit table with the flags that make a pixel unusable compiled into one
+    mask, so any array of flag values is checked with a single (flags & mask) == 0.
+
+    names[i] is the flag set by bit i. Bits past the end of the table have no name,
+    they are reported as BIT<i> and count as invalid when unknown_invalid is set.
+    """
+
+    def __init__(self, names, invalid, bits=16, unknown_invalid=False):
+        self.names = list(names)
+        self.bits = bits
+        self.invalid = list(invalid)
+        mask = 0
+        for name in self.invalid:
+            if name not in self.names:
+                raise ValueError("unknown flag %s" % name)
+            for bit, flag in enumerate(self.names):
+                if flag == name:
+                    mask |= 1 << bit
+        if unknown_invalid:
+            for bit in range(len(self.names), bits):
+                mask |= 1 << bit
+        self.mask = mask
+
+    def unsigned(self, flags):
+        # signed flag words (l2_flags is int32) are read bit for bit
+        flags = np.asarray(flags)
+        if flags.dtype.kind == 'f':
+            flags = flags.astype(np.int64)
+        if flags.dtype.kind == 'i':
+            flags = flags.view(flags.dtype.str.replace('i', 'u'))
+        return flags
+
+    def valid(self, flags):
+        """True where no invalidating flag is set, for a value or an array of any shape."""
+        flags = self.unsigned(flags)
+        return (flags & np.array(self.mask, dtype=np.uint64).astype(flags.dtype)) == 0
+
+    def count_valid(self, flags):
+        return int(np.count_nonzero(self.valid(flags)))
+
+    def decode(self, value):
+        """Names of the flags set in one value."""
+        value = int(self.unsigned(value))
+        return [self.name(bit) for bit in range(self.bits) if value >> bit & 1]
+
+    def name(self, bit):
+        if bit < len(self.names):
+            return self.names[bit]
+        return "BIT%d" % bit
+
+
+# SGLI L2 NWLR QA_flag
+SGLI_FLAGS = ['NODATA', 'LAND', 'ATMFAIL', 'CLDICE', 'CLDICEWARN', 'STRAYLIGHT', 'HIGLINT', 'MODGLINT', 'HISOLZEN', 'HIAIRSOLTHK', 'LOWLW', 'TURBIDW', 'SHALLOW', 'CDOMFAIL', 'CHLFAIL']
+SGLI_INVALID = ["ATMFAIL", "LAND", "HIGLINT", "STRAYLIGHT", "CLDICE", "NODATA"]
+
+# SeaDAS l2gen l2_flags
+SEADAS_FLAGS = ['ATMFAIL', 'LAND', 'PRODWARN', 'HIGLINT', 'HILT', 'HISATZEN', 'COASTZ', 'SPARE', 'STRAYLIGHT', 'CLDICE', 'COCCOLITH', 'TURBIDW', 'HISOLZEN', 'SPARE', 'LOWLW', 'CHLFAIL', 'NAVWARN', 'ABSAER', 'SPARE', 'MAXAERITER', 'MODGLINT', 'CHLWARN', 'ATMWARN', 'SPARE', 'SEAICE', 'NAVFAIL', 'FILTER', 'SPARE', 'BOWTIEDEL', 'HIPOL', 'PRODFAIL', 'SPARE']
+SEADAS_INVALID = ["ATMFAIL", "LAND", "HIGLINT", "HILT", "STRAYLIGHT", "CLDICE", "LOWLW", "NAVFAIL", "NAVWARN"]
+
+TABLES = {
+    # a bit past the SGLI table used to fail the whole matchup, now it fails its pixel
+    "sgli": FlagTable(SGLI_FLAGS, SGLI_INVALID, bits=16, unknown_invalid=True),
+    "seadas": FlagTable(SEADAS_FLAGS, SEADAS_INVALID, bits=32),
+    # OCSMART L2_flags has no published table, any flag set rejects the pixel
+    "ocsmart": FlagTable([], [], bits=32, unknown_invalid=True),
+}
+
+
+def get_table(name):
+    return TABLES[name]
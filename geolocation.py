@@ -0,0 +1,218 @@
+import collections
+import numpy as np
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_xyz(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def great_circle(lat1, lon1, lat2, lon2):
+    """Haversine distance in km."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+class GeoIndex:
+    """
+    Nearest pixel of a 2d lat/lon grid, built once per grid and queried for any number of stations.
+
+    Pixels are indexed as points on the unit sphere so the nearest one is the nearest
+    on the ground, across the dateline and near the poles too. Uses a scipy KD-tree
+    when scipy is installed and a brute force search otherwise.
+    """
+
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat)
+        self.lon = np.asarray(lon)
+        self.shape = self.lat.shape
+        lat = self.lat.astype(np.float64)
+        lon = self.lon.astype(np.float64)
+        # fill values (-999, 9.96e36 ...) and NaNs never match
+        with np.errstate(invalid='ignore'):
+            valid = np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90.) & (np.abs(lon) <= 360.)
+        self.pixels = np.flatnonzero(valid)
+        if self.pixels.shape[0] == 0:
+            raise ValueError("no valid geolocation in the grid")
+        xyz = to_xyz(lat.ravel()[self.pixels], lon.ravel()[self.pixels])
+        if cKDTree is not None:
+            self.tree = cKDTree(xyz)
+        else:
+            self.tree = None
+            self.xyz = xyz
+
+    def nearest(self, points):
+        if self.tree is not None:
+            chord, k = self.tree.query(points)
+            return chord, k
+        k = np.empty(points.shape[0], dtype=np.int64)
+        chord = np.empty(points.shape[0])
+        for i, p in enumerate(points):
+            d = ((self.xyz - p) ** 2).sum(axis=1)
+            k[i] = np.argmin(d)
+            chord[i] = np.sqrt(d[k[i]])
+        return chord, k
+
+    def pixel(self, row, column):
+        """Latitude and longitude of one pixel."""
+        return self.lat[row, column], self.lon[row, column]
+
+    def query(self, lat, lon):
+        """
+        Returns (row, column, distance in km) of the nearest pixel, as arrays when
+        lat/lon are arrays of stations.
+        """
+        scalar = np.ndim(lat) == 0
+        points = to_xyz(np.atleast_1d(lat), np.atleast_1d(lon)).reshape(-1, 3)
+        chord, k = self.nearest(points)
+        rows, cols = np.unravel_index(self.pixels[k], self.shape)
+        dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1.))
+        if scalar:
+            return int(rows[0]), int(cols[0]), float(dist[0])
+        return rows, cols, dist
+
+
+class IndexCache:
+    """Keeps the indexes of the last few granules, rows sharing a granule reuse its index."""
+
+    def __init__(self, size=4):
+        self.size = size
+        self.indexes = collections.OrderedDict()
+
+    def get(self, key, build):
+        if key in self.indexes:
+            self.indexes.move_to_end(key)
+            return self.indexes[key]
+        index = build()
+        self.indexes[key] = index
+        while len(self.indexes) > self.size:
+            self.indexes.popitem(last=False)
+        return index
+
+
+class TiePointLocator:
+    """
+    Nearest full resolution pixel on an SGLI tie-point grid, without upsampling the scene.
+
+    The full resolution Latitude/Longitude grids are the bilinear upsampling of the
+    tie-point grids (bilin_2d), every tie cell covers interval x interval pixels and
+    none of them leaves the bounding box of its four corners. Cells are visited in
+    order of their bounding box distance to the station and only interpolated until
+    no cell left can hold a closer pixel, so the answer is the same pixel find_entry
+    picks on the upsampled grids.
+    """
+
+    def __init__(self, lat_tie, lon_tie, interval, n_lin=None, n_pix=None):
+        self.interval = int(interval)
+        lat = np.asarray(lat_tie)
+        lon = np.asarray(lon_tie).copy()
+
+        # same dateline handling as bilin_2d(lon_mode=True)
+        self.wrapped = False
+        max_diff = np.nanmax(np.abs(lon[:, :-1] - lon[:, 1:]))
+        if max_diff > 180.:
+            lon[lon < 0] = 360. + lon[lon < 0]
+            self.wrapped = True
+
+        # the last line/column is repeated like bilin_2d does
+        self.lat = np.concatenate((lat, lat[-1].reshape(1, -1)), axis=0)
+        self.lat = np.concatenate((self.lat, self.lat[:, -1].reshape(-1, 1)), axis=1)
+        self.lon = np.concatenate((lon, lon[-1].reshape(1, -1)), axis=0)
+        self.lon = np.concatenate((self.lon, self.lon[:, -1].reshape(-1, 1)), axis=1)
+        self.ratio = np.linspace(0, (self.interval - 1) / self.interval, self.interval, dtype=np.float32)
+
+        # full resolution size, trimmed to the image like get_geometry_data
+        size_lin = lat.shape[0] * self.interval
+        size_pxl = lat.shape[1] * self.interval
+        if n_lin is not None and n_pix is not None and n_lin <= size_lin and n_pix <= size_pxl:
+            size_lin, size_pxl = n_lin, n_pix
+        self.shape = (int(size_lin), int(size_pxl))
+
+        self.lat_box = self.corner_box(self.lat)
+        self.lon_box = self.corner_box(self.lon)
+
+    def corner_box(self, data):
+        corners = np.stack((data[:-1, :-1], data[:-1, 1:], data[1:, :-1], data[1:, 1:]))
+        with np.errstate(invalid='ignore'):
+            return corners.min(axis=0), corners.max(axis=0)
+
+    def interval_distance(self, value, low, high):
+        return np.maximum(np.maximum(low - value, value - high), 0)
+
+    def lower_bounds(self, lat, lon):
+        lat_d = self.interval_distance(lat, *self.lat_box)
+        low, high = self.lon_box
+        if not self.wrapped:
+            lon_d = self.interval_distance(lon, low, high)
+        else:
+            # pixels above 180 are shifted back by 360 after the interpolation
+            with np.errstate(invalid='ignore'):
+                west = np.where(low <= 180., self.interval_distance(lon, low, np.minimum(high, 180.)), np.inf)
+                east = np.where(high > 180., self.interval_distance(lon, np.maximum(low, 180.) - 360., high - 360.), np.inf)
+            lon_d = np.minimum(west, east)
+        bounds = lat_d * lat_d + lon_d * lon_d
+        bounds[np.isnan(bounds)] = np.inf
+        return bounds
+
+    def interpolate(self, data, i, j):
+        # one tie cell of bilin_2d, with the same operations so the values match bit for bit
+        h = self.ratio
+        v = self.ratio.reshape(-1, 1)
+        top = (1. - h) * data[i, j] + h * data[i, j + 1]
+        bottom = (1. - h) * data[i + 1, j] + h * data[i + 1, j + 1]
+        return (1. - v) * top + v * bottom
+
+    def cell(self, i, j):
+        lat = self.interpolate(self.lat, i, j)
+        lon = self.interpolate(self.lon, i, j)
+        if self.wrapped:
+            lon[lon > 180.] = lon[lon > 180.] - 360.
+        # cells on the last line/column may be cut by the image size
+        rows = min(self.interval, self.shape[0] - i * self.interval)
+        cols = min(self.interval, self.shape[1] - j * self.interval)
+        return lat[:rows, :cols], lon[:rows, :cols]
+
+    def pixel(self, row, column):
+        """Latitude and longitude of one full resolution pixel."""
+        i, a = divmod(row, self.interval)
+        j, b = divmod(column, self.interval)
+        lat, lon = self.cell(i, j)
+        return lat[a, b], lon[a, b]
+
+    def find(self, lat, lon):
+        """Returns (row, column, distance^2) of the nearest full resolution pixel."""
+        bounds = self.lower_bounds(lat, lon)
+        n_cols = bounds.shape[1]
+        order = np.argsort(bounds, axis=None, kind="stable")
+        best = None
+        for k in order:
+            # a small slack keeps float rounding at the cell borders from ending the search early
+            if best is not None and bounds.flat[k] > best[0] * (1 + 1e-6) + 1e-12:
+                break
+            i, j = divmod(int(k), n_cols)
+            if i * self.interval >= self.shape[0] or j * self.interval >= self.shape[1]:
+                continue
+            cell_lat, cell_lon = self.cell(i, j)
+            lat_diff = cell_lat - lat
+            lon_diff = cell_lon - lon
+            dist = lat_diff * lat_diff + lon_diff * lon_diff
+            if np.all(np.isnan(dist)):
+                continue
+            a, b = np.unravel_index(np.nanargmin(dist), dist.shape)
+            candidate = (dist[a, b], i * self.interval + a, j * self.interval + b)
+            # ties go to the first pixel in row major order, like np.where in find_entry
+            if best is None or candidate[0] < best[0] or (candidate[0] == best[0] and candidate[1:] < best[1:]):
+                best = candidate
+        if best is None:
+            raise ValueError("no valid geolocation in the tie-point grid")
+        d, r, c = best
+        return int(r), int(c), d
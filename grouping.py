@@ -0,0 +1,58 @@
+import collections
+
+
+def group_rows(indices, key):
+    """
+    Reorders row indices so rows sharing a granule are next to each other. Groups
+    keep the order of their first row and rows keep their order inside a group.
+    """
+    groups = collections.OrderedDict()
+    for i in indices:
+        groups.setdefault(key(i), []).append(i)
+    return [i for rows in groups.values() for i in rows]
+
+
+class OrderedRows:
+    """Takes results finished in any order and hands them back in the order of `indices`."""
+
+    def __init__(self, indices):
+        self.pending = collections.deque(indices)
+        self.end = self.pending[-1] + 1 if self.pending else 0
+        self.done = {}
+
+    def next_index(self):
+        # every row before it has been handed back
+        return self.pending[0] if self.pending else self.end
+
+    def add(self, i, result):
+        # result is None for rows that produce no output
+        self.done[i] = result
+        ready = []
+        while self.pending and self.pending[0] in self.done:
+            result = self.done.pop(self.pending.popleft())
+            if result is not None:
+                ready.append(result)
+        return ready
+
+
+class OpenGranule:
+    """Keeps the files of one granule open while consecutive rows read from them."""
+
+    def __init__(self, open_files):
+        self.open_files = open_files
+        self.key = None
+        self.files = None
+
+    def get(self, key, *args):
+        if key != self.key:
+            self.close()
+            self.files = self.open_files(*args)
+            self.key = key
+        return self.files
+
+    def close(self):
+        if self.files is not None:
+            for f in self.files:
+                f.close()
+        self.key = None
+        self.files = None
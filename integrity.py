@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+
+"""
+Every download hashes the file in fixed BLOCK_SIZE blocks, aligned to the
+start of the file, while the ranges stream in, so no extra read pass is
+needed. The file checksum is the md5 over the block digests in file order.
+It only depends on the content, not on how the ranges were cut, so it can be
+compared across downloads, resumes and runs. It is stored with the size in a
+{file}.sum sidecar.
+"""
+
+# the smallest range Download cuts by default, so its ranges hold whole blocks
+BLOCK_SIZE = 250000
+
+
+def blocks(start, end, size, block_size=BLOCK_SIZE):
+    # indices of the blocks lying entirely inside start..end, the last block of the file may be short
+    first = -(-start // block_size)
+    if end + 1 >= size:
+        return range(first, -(-size // block_size))
+    return range(first, (end + 1) // block_size)
+
+
+class BlockHasher:
+    """Digests of the whole blocks of one range, fed with its bytes in order."""
+
+    def __init__(self, start, end, size, block_size=BLOCK_SIZE):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = blocks(start, end, size, block_size)
+        self.pos = start
+        self.h = hashlib.md5()
+        self.digests = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            block = self.pos // self.block_size
+            block_end = min((block + 1) * self.block_size, self.size)
+            n = min(len(view), block_end - self.pos)
+            if block in self.blocks:
+                self.h.update(view[:n])
+                if self.pos + n == block_end:
+                    self.digests.append(self.h.hexdigest())
+                    self.h = hashlib.md5()
+            self.pos += n
+            view = view[n:]
+
+    def hexdigest(self):
+        # the manifest field of the range: block size, then the block digests
+        return "%d:%s" % (self.block_size, ",".join(self.digests))
+
+
+def range_blocks(start, end, size, field, block_size=BLOCK_SIZE):
+    # block index -> digest from one manifest range
+    recorded, digests = field.split(":", 1)
+    digests = digests.split(",") if digests else []
+    expected = blocks(start, end, size, block_size)
+    if int(recorded) != block_size or len(digests) != len(expected):
+        return {}
+    return dict(zip(expected, digests))
+
+
+def file_checksum(path, size, ranges=(), block_size=BLOCK_SIZE):
+    """
+    md5 over the block digests of `path`. Digests recorded in the manifest
+    ranges are used as they are, only blocks no range held whole are read back.
+    """
+    digests = {}
+    for start, end, field in ranges:
+        digests.update(range_blocks(start, end, size, field, block_size))
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in range(-(-size // block_size)):
+            digest = digests.get(block)
+            if digest is None:
+                f.seek(block * block_size)
+                digest = hashlib.md5(f.read(block_size)).hexdigest()
+            h.update(digest.encode())
+    return h.hexdigest()
+
+
+def sum_path(path):
+    return "%s.sum" % path
+
+
+def write_sum(path, size, ranges, data_path=None):
+    # data_path is where the bytes are now, the .part file before it is renamed to path
+    record = {
+        "size": size,
+        "checksum": file_checksum(data_path or path, size, ranges),
+        "block_size": BLOCK_SIZE
+    }
+    tmp = "%s.tmp" % sum_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp, sum_path(path))
+    return record["checksum"]
+
+
+def read_sum(path):
+    try:
+        with open(sum_path(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def parse_size(value):
+    # sizes in the input csv are only trusted when they are a whole number of bytes
+    try:
+        size = float(value)
+    except (TypeError, ValueError):
+        return None
+    if size != size or size <= 0 or size != int(size):
+        return None
+    return int(size)
+
+
+def verify(path, expected_size=None, deep=True):
+    """
+    True if `path` holds a complete granule: its size matches the expected size
+    (from the csv or the server) and the recorded one, and, when deep and a
+    checksum was recorded, the content still hashes to it.
+    """
+    if not os.path.exists(path):
+        return False
+    size = os.path.getsize(path)
+    record = read_sum(path)
+    if expected_size is not None and size != expected_size:
+        return False
+    if record is None:
+        return expected_size is not None
+    if size != record["size"]:
+        return False
+    if deep and record.get("checksum"):
+        return file_checksum(path, size, block_size=record.get("block_size", BLOCK_SIZE)) == record["checksum"]
+    return True
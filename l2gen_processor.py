@@ -3,6 +3,8 @@ import h5py
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from geolocation import GeoIndex, IndexCache
+from grouping import group_rows, OpenGranule
 
 
 """
@@ -14,11 +16,16 @@ An HDF5 file contains datasets & groups
 
 
 class L2genProcessor:
-    def __init__(self, directory, input_csv, output_csv):
+    def __init__(self, directory, input_csv, output_csv, catalog=None, cache=None):
         self.out_file = Path(output_csv)
         self.out_file.touch(exist_ok=True)
         self.in_dir = Path(directory)
         self.input_csv = Path(input_csv)
+        # optional catalog.Catalog, each l2gen run is tracked under the "l2gen" stage
+        self.catalog = catalog
+        # optional cache.GranuleCache over `directory`, queued rows pin their l1b files
+        self.cache = cache
+        self.indexes = IndexCache()
         self.out_colums = [
             "Global_ID",
             "pixel_lat",
@@ -45,6 +52,8 @@ class L2genProcessor:
 
     def get_h5_file(self, path):
         print("reading file: %s" % path)
+        if self.cache is not None:
+            self.cache.touch(path)
         f = h5py.File(path, 'r')
         # print("###############", "Main Groups:", list(f.keys()), sep="\n")
         return f
@@ -245,47 +254,96 @@ class L2genProcessor:
             "ag_443": l2_row["ag_443"]
         }, ignore_index=True)
 
-    def start(self, start_index=0):
+    def l1b_files(self, vnr_id):
+        vnr_file = os.path.join(self.in_dir, vnr_id+".h5")
+        irs_file = os.path.join(self.in_dir, vnr_id.replace("VNRDQ", "IRSDQ")+".h5")
+        return vnr_file, irs_file
+
+    def pin_rows(self, in_df, start_index):
+        for i in range(start_index, in_df.shape[0]):
+            vnr_id = in_df.iloc[i]["l1b_gportal_id"]
+            if type(vnr_id) == str:
+                for path in self.l1b_files(vnr_id):
+                    self.cache.pin(path, "l2gen")
+
+    def done_with_row(self, row):
+        if self.cache is None or type(row["l1b_gportal_id"]) != str:
+            return
+        for path in self.l1b_files(row["l1b_gportal_id"]):
+            self.cache.unpin(path, "l2gen")
+            self.cache.release(path)
+
+    def group_key(self, row):
+        return row["l1b_gportal_id"] if type(row["l1b_gportal_id"]) == str else None
+
+    def start(self, start_index=0, grouped=False):
         in_df = pd.read_csv(self.input_csv)
         # out_df = pd.read_csv(self.out_file)
         out_df = pd.DataFrame(columns=self.out_colums)
-        for i in range(start_index, in_df.shape[0]):
-            row = in_df.iloc[i]
-            out_row = {
-                "Global_ID": row["Global_ID"],
-                "in_situ_lat": row["lat"],
-                "in_situ_lon": row["lon"],
-                "Date": row["Date"],
-                "l1b_gportal_id": row["l1b_gportal_id"],
-            }
-            if type(row["l1b_gportal_id"]) != str:
-                continue
-            print("processing file #: ", i)
-            print("id: ", row["l1b_gportal_id"])
-            vnr_id = row["l1b_gportal_id"]
-            vnr_file = os.path.join(self.in_dir, vnr_id+".h5")
-            irs_id = vnr_id.replace("VNRDQ", "IRSDQ")
-            irs_file = os.path.join(self.in_dir, irs_id+".h5")
-            if not os.path.exists(irs_file):
-                continue
+        if self.cache is not None:
+            self.pin_rows(in_df, start_index)
+        rows = range(start_index, in_df.shape[0])
+        if grouped:
+            # every station of an l1b granule is cropped while its IRS file is open
+            rows = group_rows(rows, lambda i: self.group_key(in_df.iloc[i]))
+        granules = OpenGranule(lambda path: (self.get_h5_file(path),))
+        for i in rows:
             try:
-                irs = self.get_h5_file(irs_file)
-            except:
-                continue
-            lat = irs["Geometry_data"]["Latitude"][:]
-            lon = irs["Geometry_data"]["Longitude"][:]
-            x, y, dist = self.find_entry(lat, lon, row["lat"], row["lon"])
-            x2 = x * 10
-            y2 = y * 10
-            print("best match is at: %f, %f, with dist: %f, for lat: %f, lon: %f, found: %f, %f" % (
-                x, y, dist, row["lat"], row["lon"], lat[x, y], lon[x, y]))
-            print("GID: ", row["Global_ID"])
-            ofile = "/home/shared/Data/SGLI/seadas_processed_large_with_land/"+vnr_id[0:25] + "_" + str(row["Global_ID"]) + ".nc"
-            command = "l2gen ifile=%s l2prod=Kd_490,Rrs_vvv,a_vvv_qaa,adg_vvv_qaa,angstrom,aot_867,aph_vvv_qaa,chlor_a aer_opt=-10 iop_opt=3 ofile=%s spixl=%d epixl=%d sline=%d eline=%d proc_land=1" % (
-                vnr_file, ofile, y2-1000, y2+1000, x2-1000, x2+1000)
-            print("command : ", command)
-            exit_status = os.system(command)
-            print("processings done with exit code: ", exit_status)
+                self.process_row(in_df.iloc[i], i, granules)
+            finally:
+                self.done_with_row(in_df.iloc[i])
+        granules.close()
+
+    def process_row(self, row, i, granules):
+        out_row = {
+            "Global_ID": row["Global_ID"],
+            "in_situ_lat": row["lat"],
+            "in_situ_lon": row["lon"],
+            "Date": row["Date"],
+            "l1b_gportal_id": row["l1b_gportal_id"],
+        }
+        if type(row["l1b_gportal_id"]) != str:
+            return
+        print("processing file #: ", i)
+        print("id: ", row["l1b_gportal_id"])
+        vnr_id = row["l1b_gportal_id"]
+        vnr_file = os.path.join(self.in_dir, vnr_id+".h5")
+        irs_id = vnr_id.replace("VNRDQ", "IRSDQ")
+        irs_file = os.path.join(self.in_dir, irs_id+".h5")
+        product_id = vnr_id[0:25] + "_" + str(row["Global_ID"])
+        # checked before the granule is opened and indexed, a resumed run skips straight past
+        if self.catalog is not None and self.catalog.state(product_id, "l2gen") == "processed":
+            print("already processed")
+            return
+        if not os.path.exists(irs_file):
+            return
+        try:
+            irs, = granules.get(irs_file, irs_file)
+        except:
+            return
+        # rows sharing an l1b granule reuse the index of its tie-point grid
+        index = self.indexes.get(irs_file, lambda: GeoIndex(irs["Geometry_data"]["Latitude"][:],
+                                                            irs["Geometry_data"]["Longitude"][:]))
+        x, y, dist = index.query(row["lat"], row["lon"])
+        x2 = x * 10
+        y2 = y * 10
+        print("best match is at: %d, %d, with dist: %f km, for lat: %f, lon: %f, found: %f, %f" % (
+            (x, y, dist, row["lat"], row["lon"]) + index.pixel(x, y)))
+        print("GID: ", row["Global_ID"])
+        ofile = "/home/shared/Data/SGLI/seadas_processed_large_with_land/" + product_id + ".nc"
+        command = "l2gen ifile=%s l2prod=Kd_490,Rrs_vvv,a_vvv_qaa,adg_vvv_qaa,angstrom,aot_867,aph_vvv_qaa,chlor_a aer_opt=-10 iop_opt=3 ofile=%s spixl=%d epixl=%d sline=%d eline=%d proc_land=1" % (
+            vnr_file, ofile, y2-1000, y2+1000, x2-1000, x2+1000)
+        print("command : ", command)
+        if self.cache is not None:
+            self.cache.touch(vnr_file)
+        exit_status = os.system(command)
+        print("processings done with exit code: ", exit_status)
+        if self.catalog is not None:
+            if exit_status == 0:
+                self.catalog.set_state(product_id, "processed", stage="l2gen", path=ofile)
+            else:
+                self.catalog.set_state(product_id, "failed", stage="l2gen", path=ofile,
+                                       error="l2gen exit status %d" % exit_status)
         #     if exit_status != 0:
         #         continue
         #     os.system(
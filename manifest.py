@@ -0,0 +1,79 @@
+import os
+import threading
+
+
+class Manifest:
+  """
+  Sidecar record of the byte ranges of a download that already landed on disk.
+  The first line holds the total size, every following line one completed
+  "start end digests" range (see integrity.BlockHasher). Lines are only ever
+  appended so a killed run leaves at worst a truncated last line, which is
+  ignored on load.
+  """
+  def __init__(self, path, size):
+    self.path = path
+    self.size = size
+    self.done = []
+    self.digests = {}
+    self.lock = threading.Lock()
+
+  def load(self):
+    self.done = []
+    self.digests = {}
+    if not os.path.exists(self.path):
+      return self.done
+    with open(self.path, 'r') as f:
+      lines = f.read().split("\n")
+    try:
+      size = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+      size = None
+    if size != self.size:
+      # the remote file changed (or the manifest is garbage), start over
+      self.reset()
+      return self.done
+    # the last element is whatever followed the final newline, never a whole line
+    for line in lines[1:-1]:
+      fields = line.split()
+      try:
+        start, end, digest = int(fields[0]), int(fields[1]), fields[2]
+      except (IndexError, ValueError):
+        continue
+      self.done.append((start, end))
+      self.digests[(start, end)] = digest
+    return self.done
+
+  def reset(self):
+    self.done = []
+    self.digests = {}
+    with open(self.path, 'w') as f:
+      f.write("size %d\n" % self.size)
+
+  def add(self, start, end, digest):
+    with self.lock:
+      if not os.path.exists(self.path):
+        self.reset()
+      with open(self.path, 'a') as f:
+        f.write("%d %d %s\n" % (start, end, digest))
+      self.done.append((start, end))
+      self.digests[(start, end)] = digest
+
+  def ranges(self):
+    # (start, end, digests) of every completed range in file order
+    return [(start, end, self.digests[(start, end)]) for start, end in sorted(self.done)]
+
+  def missing(self, chunk_size):
+    # walk the gaps between completed ranges and cut them into chunks
+    ranges = []
+    pos = 0
+    for start, end in sorted(self.done) + [(self.size, self.size)]:
+      while pos < start:
+        stop = min(pos + chunk_size, start)
+        ranges.append((pos, stop - 1))
+        pos = stop
+      pos = max(pos, end + 1)
+    return ranges
+
+  def remove(self):
+    if os.path.exists(self.path):
+      os.remove(self.path)
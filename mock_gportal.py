@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import random
+import threading
+import http.server
+
+"""
+Local stand-in for G-Portal so Download/Downloader can be measured and
+regression-tested offline. It answers the authenticate.json POST, HEAD with
+Content-Length and ranged GETs for any file name, with optional per-request
+latency, a per-connection bandwidth cap, random 5xx errors and sessions that
+expire after session_ttl seconds.
+
+    server = MockGPortal(size=200000000, latency=0.05, error_rate=0.01).start()
+    d = Download("token", "account", "password", auth_url=server.auth_url)
+    d.get(server.url("GC1SG1_TEST_VNRDQ.h5"), "/tmp/test.h5", 10)
+    server.stop()
+"""
+
+AUTH_PATH = "/gpr/auth/authenticate.json"
+
+
+class MockGPortal:
+    def __init__(self, size=100000000, sizes=None, latency=0., bandwidth=None, error_rate=0.,
+                 session_ttl=None, host="127.0.0.1", port=0, seed=0, files=None):
+        self.size = size
+        self.sizes = sizes or {}
+        # name -> local path, served as is instead of synthetic content
+        self.files = files or {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        # the content of every file is this block repeated, so any byte is cheap to produce
+        self.block = random.Random(seed).randbytes(1 << 20)
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.stats = {"auth": 0, "head": 0, "get": 0, "errors": 0, "expired": 0, "bytes": 0}
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return "http://%s:%d" % (self.host, self.port)
+
+    @property
+    def auth_url(self):
+        return self.base_url + AUTH_PATH
+
+    def url(self, name):
+        return "%s/data/%s" % (self.base_url, name)
+
+    def file_size(self, path):
+        name = os.path.basename(path)
+        if name in self.files:
+            return os.path.getsize(self.files[name])
+        return self.sizes.get(name, self.size)
+
+    def content(self, start, end, path=""):
+        # bytes start..end inclusive of the file
+        name = os.path.basename(path)
+        if name in self.files:
+            with open(self.files[name], 'rb') as f:
+                f.seek(start)
+                return f.read(end - start + 1)
+        n = len(self.block)
+        out = bytearray()
+        pos = start
+        while pos <= end:
+            offset = pos % n
+            take = min(n - offset, end - pos + 1)
+            out += self.block[offset:offset + take]
+            pos += take
+        return bytes(out)
+
+    def expected(self, path):
+        return self.content(0, self.file_size(path) - 1, path)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def new_session(self):
+        with self.lock:
+            session = "%016x" % self.random.getrandbits(64)
+            self.sessions[session] = time.time()
+        return session
+
+    def session_valid(self, cookie):
+        match = re.search(r"session=([0-9a-f]+)", cookie or "")
+        if match is None:
+            return False
+        with self.lock:
+            created = self.sessions.get(match.group(1))
+        if created is None:
+            return False
+        return self.session_ttl is None or time.time() - created < self.session_ttl
+
+    def fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def start(self):
+        mock = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, headers=None, body=b""):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if body and self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def authorized(self):
+                if mock.session_valid(self.headers.get("Cookie")):
+                    return True
+                mock.count("expired")
+                self.reply(401)
+                return False
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path != AUTH_PATH:
+                    return self.reply(404)
+                mock.count("auth")
+                session = mock.new_session()
+                # same shape as the real header: the session cookie comes after "secure, "
+                cookie = "fuel_csrf_token=mock; path=/; secure, session=%s" % session
+                self.reply(200, {"Set-Cookie": cookie, "Content-Type": "application/json"}, b'{"status":"success"}')
+
+            def do_HEAD(self):
+                mock.count("head")
+                time.sleep(mock.latency)
+                if not self.authorized():
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(mock.file_size(self.path)))
+                self.send_header("Accept-Ranges", "bytes")
+                self.end_headers()
+
+            def do_GET(self):
+                mock.count("get")
+                time.sleep(mock.latency)
+                if not self.authorized():
+                    return
+                if mock.fail():
+                    mock.count("errors")
+                    return self.reply(mock.random.choice([500, 502, 503]))
+                size = mock.file_size(self.path)
+                match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if match is None:
+                    start, end, status = 0, size - 1, 200
+                else:
+                    start = int(match.group(1))
+                    end = min(int(match.group(2) or size - 1), size - 1)
+                    status = 206
+                if start > end:
+                    return self.reply(416)
+                self.send_response(status)
+                self.send_header("Content-Length", str(end - start + 1))
+                if status == 206:
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+                self.end_headers()
+                self.stream(start, end)
+
+            def stream(self, start, end):
+                # bandwidth is a per-connection cap, enforced block by block
+                step = 65536
+                pos = start
+                began = time.time()
+                while pos <= end:
+                    stop = min(pos + step, end + 1)
+                    self.wfile.write(mock.content(pos, stop - 1, self.path))
+                    mock.count("bytes", stop - pos)
+                    pos = stop
+                    if mock.bandwidth:
+                        ahead = (pos - start) / mock.bandwidth - (time.time() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
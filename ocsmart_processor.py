@@ -12,7 +12,7 @@ An HDF5 file contains datasets & groups
 
 
 class OCSMARTProcessor:
-    def __init__(self, l1b_path, l2_path, ocsmart_path, temp_l1b_path, temp_geo_path, input_csv, start_index = 0):
+    def __init__(self, l1b_path, l2_path, ocsmart_path, temp_l1b_path, temp_geo_path, input_csv, start_index = 0, catalog=None, cache=None):
         self.l1b_path = l1b_path
         self.l2_path = l2_path
         self.ocsmart_path = ocsmart_path
@@ -20,6 +20,10 @@ class OCSMARTProcessor:
         self.temp_geo_path = temp_geo_path
         self.index = start_index
         self.input_csv = input_csv
+        # optional catalog.Catalog, each run is tracked under the "ocsmart" stage
+        self.catalog = catalog
+        # optional cache.GranuleCache over l1b_path, queued files are pinned until processed
+        self.cache = cache
 
     def get_list_of_files(self):
         in_df = pd.read_csv(self.input_csv)
@@ -27,6 +31,8 @@ class OCSMARTProcessor:
         for i in range(self.index, in_df.shape[0]):
             row = in_df.iloc[i]
             vnr_id = row["l1b_gportal_id"]
+            if type(vnr_id) != str:
+                continue
             vnr_file = os.path.join(self.l1b_path, vnr_id+".h5")
             irs_id = vnr_id.replace("VNRDQ", "IRSDQ")
             irs_file = os.path.join(self.l1b_path, irs_id+".h5")
@@ -34,7 +40,11 @@ class OCSMARTProcessor:
             lon = row["lon"]
             if not os.path.exists(irs_file) or not os.path.exists(vnr_file):
                 continue
+            product_id = vnr_id + "_" + str(row["Global_ID"])
+            if self.catalog is not None and self.catalog.state(product_id, "ocsmart") == "processed":
+                continue
             files.append({
+                "id": product_id,
                 "l1b_path": vnr_file,
                 "l1b": vnr_id + ".h5",
                 "geo_path": irs_file,
@@ -68,11 +78,21 @@ class OCSMARTProcessor:
             f.write(box_h)
 
     
+    def stage_file(self, src, dst):
+        # a hard link costs no space, only copy when the temp dir is on another filesystem
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+
     def prepare_current(self):
         current = self.files[self.index]
+        if self.cache is not None:
+            self.cache.touch(current["l1b_path"])
+            self.cache.touch(current["geo_path"])
         try:
-            shutil.copy(current["l1b_path"], os.path.join(self.temp_l1b_path, current["l1b"]))
-            shutil.copy(current["geo_path"], os.path.join(self.temp_geo_path, current["geo"]))
+            self.stage_file(current["l1b_path"], os.path.join(self.temp_l1b_path, current["l1b"]))
+            self.stage_file(current["geo_path"], os.path.join(self.temp_geo_path, current["geo"]))
             self.write_config()
             return True
         except:
@@ -83,6 +103,24 @@ class OCSMARTProcessor:
         os.system("rm -r %s/*"%self.temp_l1b_path)
         os.system("rm -r %s/*"%self.temp_geo_path)
 
+    def update_catalog(self, exit_status):
+        if self.catalog is None:
+            return
+        current = self.files[self.index]
+        if exit_status == 0:
+            self.catalog.set_state(current["id"], "processed", stage="ocsmart", path=self.l2_path)
+        else:
+            self.catalog.set_state(current["id"], "failed", stage="ocsmart",
+                                   error="OCSMART exit status %d" % exit_status)
+
+    def done_with_current(self):
+        if self.cache is None:
+            return
+        current = self.files[self.index]
+        for path in [current["l1b_path"], current["geo_path"]]:
+            self.cache.unpin(path, "ocsmart")
+            self.cache.release(path)
+
     def next(self):
         self.index = self.index + 1
         if self.index < len(self.files):
@@ -91,7 +129,15 @@ class OCSMARTProcessor:
             return False
 
     def start(self):
-        self.get_list_of_files()
+        # start_index is a csv row, from here on index walks the file list
+        self.files = self.get_list_of_files()
+        self.index = 0
+        if len(self.files) == 0:
+            return
+        if self.cache is not None:
+            for current in self.files:
+                self.cache.pin(current["l1b_path"], "ocsmart")
+                self.cache.pin(current["geo_path"], "ocsmart")
         self.clear_temp()
         while(True):
             print("processing # %d of %d"%(self.index, len(self.files)))
@@ -102,13 +148,15 @@ class OCSMARTProcessor:
                     print("processing was successful!!")
                 else:
                     print("failed!")
+                self.update_catalog(exit_status)
                 self.clear_temp()
+            self.done_with_current()
             if not self.next():
                 break
 
-    
-    
-p = ProcessOCSMART("/home/shared/Data/SGLI/sgli-lvl1/", "/home/shared/Data/SGLI/ocsmart_processed/", "/home/shared/ocsmart/Python_Linux/", "/home/muhammad/process_sgli/l1b", "/home/muhammad/process_sgli/geo")
-p.start()
+
+
+# p = OCSMARTProcessor("/home/shared/Data/SGLI/sgli-lvl1/", "/home/shared/Data/SGLI/ocsmart_processed/", "/home/shared/ocsmart/Python_Linux/", "/home/muhammad/process_sgli/l1b", "/home/muhammad/process_sgli/geo", "./input_data.csv")
+# p.start()
 
     
\ No newline at end of file
@@ -0,0 +1,234 @@
+import os
+import csv
+import glob
+import json
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""
+Matchup rows are appended to the output as they are extracted, never rewritten.
+Every `sync_every` input rows the file is flushed and fsynced, then a {file}.checkpoint
+sidecar records the file size, the number of rows and the next input index to
+process. A restarted run truncates whatever was appended after the last
+checkpoint and carries on from that index.
+
+The parquet output is a directory of part files, each one written whole and
+renamed into place, so the checkpoint only has to remember how many parts
+were committed.
+"""
+
+# column types of the parquet output, the extractors give one per column
+TYPES = {
+    "bool": "bool_",
+    "uint16": "uint16",
+    "uint32": "uint32",
+    "int64": "int64",
+    "float32": "float32",
+    "float64": "float64",
+    "string": "string",
+}
+
+
+def checkpoint_path(path):
+    return "%s.checkpoint" % path
+
+
+def read_checkpoint(path):
+    try:
+        with open(checkpoint_path(path), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(path, record):
+    tmp = "%s.tmp" % checkpoint_path(path)
+    with open(tmp, 'w') as f:
+        json.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, checkpoint_path(path))
+
+
+class CsvMatchupWriter:
+    """
+    Appends matchup rows in the layout of DataFrame.to_csv: an unnamed index column
+    counting the rows, then `columns`.
+    """
+
+    def __init__(self, path, columns, sync_every=10):
+        self.path = str(path)
+        self.columns = list(columns)
+        self.sync_every = sync_every
+        self.f = None
+        self.writer = None
+        self.rows = 0
+        self.unsynced = 0
+        self.next_index = 0
+
+    def open(self, start_index=None):
+        """
+        Opens the output and returns the input index to start from. With no start_index
+        the previous run is resumed from its checkpoint, otherwise the output starts over.
+        """
+        record = read_checkpoint(self.path) if start_index is None else None
+        if record is not None and os.path.exists(self.path) and os.path.getsize(self.path) >= record["size"]:
+            # rows appended after the last checkpoint were never committed
+            with open(self.path, 'r+b') as f:
+                f.truncate(record["size"])
+            self.f = open(self.path, 'a', newline='')
+            self.rows = record["rows"]
+            self.next_index = record["next_index"]
+            print("resuming %s at input row %d, %d rows already written" % (self.path, self.next_index, self.rows))
+        else:
+            self.f = open(self.path, 'w', newline='')
+            self.rows = 0
+            self.next_index = start_index or 0
+        self.writer = csv.writer(self.f)
+        if self.rows == 0 and self.f.tell() == 0:
+            self.writer.writerow([""] + self.columns)
+        self.sync()
+        return self.next_index
+
+    def write(self, record):
+        self.writer.writerow([self.rows] + [self.format(record.get(c)) for c in self.columns])
+        self.rows += 1
+
+    def format(self, value):
+        # NaN is written as an empty field, like to_csv does
+        if value is None or (isinstance(value, (float, np.floating)) and np.isnan(value)):
+            return ""
+        return value
+
+    def commit(self, next_index):
+        # every input row before next_index is written (or had nothing to write)
+        self.unsynced += next_index - self.next_index
+        self.next_index = next_index
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        size = os.fstat(self.f.fileno()).st_size
+        write_checkpoint(self.path, {"size": size, "rows": self.rows, "next_index": self.next_index})
+        self.unsynced = 0
+
+    def close(self):
+        if self.f is None:
+            return
+        self.sync()
+        self.f.close()
+        self.f = None
+
+
+def arrow_schema(columns, types):
+    return pa.schema([(c, getattr(pa, TYPES[types[c]])()) for c in columns])
+
+
+def is_parquet(path):
+    return os.path.isdir(path) or str(path).endswith(".parquet")
+
+
+def iter_parquet(path, columns=None, batch_size=100000):
+    """Reads a parquet output batch by batch, only `columns` of it."""
+    if pa is None:
+        raise ImportError("parquet output needs the pyarrow package")
+    for part in part_files(path) if os.path.isdir(path) else [path]:
+        f = pq.ParquetFile(part)
+        present = None if columns is None else [c for c in columns if c in f.schema_arrow.names]
+        for batch in f.iter_batches(batch_size=batch_size, columns=present):
+            yield batch.to_pandas()
+
+
+def part_files(path):
+    return sorted(glob.glob(os.path.join(str(path), "part-*.parquet")))
+
+
+class ParquetMatchupWriter:
+    """
+    Same interface as CsvMatchupWriter, with a typed schema. Rows are buffered and
+    written as a part file once `part_rows` are waiting, so parts are not tiny.
+    """
+
+    def __init__(self, path, columns, types, sync_every=10, part_rows=1000):
+        if pa is None:
+            raise ImportError("parquet output needs the pyarrow package")
+        self.path = str(path)
+        self.columns = list(columns)
+        self.schema = arrow_schema(self.columns, types)
+        self.sync_every = sync_every
+        self.part_rows = part_rows
+        self.buffer = []
+        self.parts = 0
+        self.rows = 0
+        self.unsynced = 0
+        self.next_index = 0
+
+    def open(self, start_index=None):
+        record = read_checkpoint(self.path) if start_index is None else None
+        if record is not None and os.path.isdir(self.path) and len(part_files(self.path)) >= record["parts"]:
+            self.parts = record["parts"]
+            self.rows = record["rows"]
+            self.next_index = record["next_index"]
+            print("resuming %s at input row %d, %d rows already written" % (self.path, self.next_index, self.rows))
+        else:
+            self.parts = 0
+            self.rows = 0
+            self.next_index = start_index or 0
+        os.makedirs(self.path, exist_ok=True)
+        # parts past the checkpoint were never committed
+        for part in part_files(self.path)[self.parts:]:
+            os.remove(part)
+        self.sync()
+        return self.next_index
+
+    def write(self, record):
+        self.buffer.append(record)
+        self.rows += 1
+
+    def column(self, name, field):
+        values = [r.get(name) for r in self.buffer]
+        if pa.types.is_unsigned_integer(field.type):
+            # flag words may come in as signed, keep their bits
+            bits = field.type.bit_width
+            values = [None if v is None else int(v) & ((1 << bits) - 1) for v in values]
+        elif pa.types.is_string(field.type):
+            values = [None if v is None or (isinstance(v, float) and v != v) else str(v) for v in values]
+        return pa.array(values, type=field.type, from_pandas=True)
+
+    def commit(self, next_index):
+        self.unsynced += next_index - self.next_index
+        self.next_index = next_index
+        # the checkpoint can only move past rows that are in a part file
+        if len(self.buffer) >= self.part_rows or (not self.buffer and self.unsynced >= self.sync_every):
+            self.sync()
+
+    def sync(self):
+        if self.buffer:
+            table = pa.Table.from_arrays([self.column(f.name, f) for f in self.schema], schema=self.schema)
+            name = "part-%05d.parquet" % self.parts
+            # a leading dot hides a half written part from readers of the directory
+            tmp = os.path.join(self.path, ".%s.tmp" % name)
+            pq.write_table(table, tmp)
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+            os.replace(tmp, os.path.join(self.path, name))
+            self.parts += 1
+            self.buffer = []
+        write_checkpoint(self.path, {"parts": self.parts, "rows": self.rows, "next_index": self.next_index})
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+
+
+def open_writer(path, columns, types, output="csv", sync_every=10):
+    if output == "parquet":
+        return ParquetMatchupWriter(path, columns, types, sync_every)
+    return CsvMatchupWriter(path, columns, sync_every)
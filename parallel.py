@@ -0,0 +1,64 @@
+import collections
+import concurrent.futures
+import copy
+from grouping import OpenGranule
+
+
+def worker_copy(extractor):
+    # the catalog and the cache stay with the parent process
+    worker = copy.copy(extractor)
+    worker.catalog = None
+    worker.cache = None
+    return worker
+
+
+def extract_rows(extractor, rows):
+    """
+    Runs process_row over (index, row) pairs, yielding (index, result, error). A row that
+    raises is reported with its error instead of stopping the others.
+    """
+    granules = OpenGranule(extractor.open_granules)
+    try:
+        for i, row in rows:
+            print("processing row # %d" % i)
+            try:
+                yield i, extractor.process_row(row, granules), None
+            except Exception as e:
+                yield i, None, "%s: %s" % (type(e).__name__, e)
+    finally:
+        granules.close()
+
+
+def extract_group(extractor, rows):
+    # entry point of the worker processes, one call per granule
+    return list(extract_rows(extractor, rows))
+
+
+def run_serial(extractor, in_df, rows):
+    return extract_rows(extractor, ((i, in_df.iloc[i]) for i in rows))
+
+
+def run_parallel(extractor, in_df, rows, key, workers):
+    """
+    Fans the granules out to `workers` processes, each opening its own files. Yields
+    (index, result, error) as granules finish, OrderedRows puts them back in csv order.
+    """
+    if getattr(extractor, "remote", None) is not None:
+        raise ValueError("parallel extraction reads local granules only")
+    groups = collections.OrderedDict()
+    for i in rows:
+        row = in_df.iloc[i]
+        groups.setdefault(key(row), []).append((i, row))
+    worker = worker_copy(extractor)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for group in groups.values():
+            futures[pool.submit(extract_group, worker, group)] = group
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                # the worker died, every row of its granule failed
+                results = [(i, None, "%s: %s" % (type(e).__name__, e)) for i, _ in futures[future]]
+            for result in results:
+                yield result
@@ -0,0 +1,95 @@
+import io
+import collections
+import threading
+
+"""
+Read-only file object over a G-Portal granule, backed by the authenticated
+range requests of a Download. h5py can open it directly:
+
+    f = h5py.File(RemoteFile(download, link), 'r')
+
+so only the HDF5 metadata and the chunks a read actually touches are
+transferred. Reads are served from an LRU cache of fixed size blocks and
+runs of missing blocks are fetched with a single range request.
+"""
+
+
+class RemoteFile(io.RawIOBase):
+    def __init__(self, downloader, url, block_size=1 << 18, cache_blocks=512):
+        self.downloader = downloader
+        self.url = url
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.position = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+        downloader.ensure_auth()
+        self.size = downloader.head_size(url)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        else:
+            raise ValueError("invalid whence: %r" % whence)
+        return self.position
+
+    def fetch(self, first, last):
+        start = first * self.block_size
+        end = min((last + 1) * self.block_size, self.size) - 1
+        data = self.downloader.read_range(self.url, start, end)
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        blocks = [data[(i - first) * self.block_size:(i - first + 1) * self.block_size]
+                  for i in range(first, last + 1)]
+        for i, block in zip(range(first, last + 1), blocks):
+            self.cache[i] = block
+        while len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return blocks
+
+    def blocks(self, first, last):
+        # cached blocks first..last, missing runs are fetched one request each
+        out = []
+        with self.lock:
+            i = first
+            while i <= last:
+                if i in self.cache:
+                    self.cache.move_to_end(i)
+                    out.append(self.cache[i])
+                    i += 1
+                    continue
+                j = i
+                while j + 1 <= last and j + 1 not in self.cache:
+                    j += 1
+                out.extend(self.fetch(i, j))
+                i = j + 1
+        return out
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        end = min(self.position + len(view), self.size)
+        if end <= self.position:
+            return 0
+        first = self.position // self.block_size
+        last = (end - 1) // self.block_size
+        data = b"".join(self.blocks(first, last))
+        offset = self.position - first * self.block_size
+        n = end - self.position
+        view[:n] = data[offset:offset + n]
+        self.position = end
+        return n
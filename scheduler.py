@@ -0,0 +1,116 @@
+import time
+import threading
+import contextlib
+import concurrent.futures
+
+
+class TransferBudget:
+    """
+    Global cap on open range requests and bytes in flight, shared by every
+    granule a Download is fetching at the same time.
+    """
+    def __init__(self, max_connections=None, max_inflight_bytes=None):
+        self.max_connections = max_connections
+        self.max_inflight_bytes = max_inflight_bytes
+        self.connections = 0
+        self.inflight_bytes = 0
+        self.cond = threading.Condition()
+        # callbacks of AsyncTransport ranges waiting on their event loop
+        self.waiters = []
+
+    def fits(self, nbytes):
+        if self.max_connections is not None and self.connections >= self.max_connections:
+            return False
+        # a range bigger than the whole budget may still go, but only alone
+        if self.max_inflight_bytes is not None and self.inflight_bytes > 0 \
+                and self.inflight_bytes + nbytes > self.max_inflight_bytes:
+            return False
+        return True
+
+    def limited(self):
+        return self.max_connections is not None or self.max_inflight_bytes is not None
+
+    def acquire(self, nbytes):
+        with self.cond:
+            while not self.fits(nbytes):
+                self.cond.wait()
+            self.connections += 1
+            self.inflight_bytes += nbytes
+
+    def try_acquire(self, nbytes, waiter=None):
+        # takes the budget if it fits right now, otherwise waiter() is called at the next release
+        with self.cond:
+            if self.fits(nbytes):
+                self.connections += 1
+                self.inflight_bytes += nbytes
+                return True
+            if waiter is not None:
+                self.waiters.append(waiter)
+            return False
+
+    def release(self, nbytes):
+        with self.cond:
+            self.connections -= 1
+            self.inflight_bytes -= nbytes
+            self.cond.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        self.acquire(nbytes)
+        try:
+            yield
+        finally:
+            self.release(nbytes)
+
+
+class GranuleScheduler:
+    """
+    Keeps up to max_granules files downloading at once through one Download,
+    so small granules and the VNRDQ/IRSDQ (or NWLR/IWPR) pairs overlap
+    instead of running back to back.
+    """
+    def __init__(self, downloader, max_granules=4):
+        self.downloader = downloader
+        self.max_granules = max_granules
+
+    def report(self, start_time, start_bytes):
+        elapsed = time.time() - start_time
+        mb = (self.downloader.bytes_downloaded - start_bytes) / 1e6
+        print("%.1f MB in %.1f s (%.2f MB/s)" % (mb, elapsed, mb / max(elapsed, 1e-6)))
+
+    def fetch(self, url, path, max_workers, listener):
+        if listener is not None:
+            listener.started(url, path)
+        self.downloader.get(url, path, max_workers)
+
+    def run(self, jobs, listener=None):
+        # jobs are (url, output path, max_workers) tuples, returns the failed ones.
+        # listener, if given, gets started(url, path) and finished(url, path, error)
+        jobs = list(jobs)
+        # max_granules get() calls share the one keep-alive pool
+        self.downloader.size_pool(self.max_granules * max([w for _, _, w in jobs] or [1]))
+        start_time = time.time()
+        start_bytes = self.downloader.bytes_downloaded
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_granules) as executor:
+            futures = {
+                executor.submit(self.fetch, url, path, max_workers, listener): (url, path, max_workers)
+                for url, path, max_workers in jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                url, path, _ = futures[future]
+                error = None
+                try:
+                    future.result()
+                    print("download complete: %s" % path)
+                except Exception as e:
+                    print("cannot download %s: %s" % (url, e))
+                    failed.append(futures[future])
+                    error = e
+                if listener is not None:
+                    listener.finished(url, path, error)
+                self.report(start_time, start_bytes)
+        return failed
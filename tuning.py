@@ -0,0 +1,78 @@
+import time
+
+
+class AdaptiveTuner:
+  """
+  Picks the range size and number of concurrent ranges for one download from
+  what the transfer is actually doing. The range size is steered so a range
+  takes between target_latency seconds; the concurrency hill-climbs on the
+  aggregate throughput of each window of completed ranges and is halved
+  whenever the server throttles us.
+  """
+  def __init__(self, chunk_size, concurrency, min_chunk_size, max_chunk_size, max_concurrency,
+               min_concurrency=1, target_latency=(1.0, 4.0), window=8):
+    self.chunk_size = chunk_size
+    self.min_chunk_size = min_chunk_size
+    self.max_chunk_size = max_chunk_size
+    self.min_concurrency = min_concurrency
+    self.max_concurrency = max_concurrency
+    self.concurrency = min(max(concurrency, min_concurrency), max_concurrency)
+    self.target_latency = target_latency
+    self.window = window
+    self.direction = 1
+    self.last_rate = None
+    self.history = []
+    self.reset_window()
+
+  def reset_window(self):
+    self.window_start = time.time()
+    self.window_bytes = 0
+    self.latencies = []
+
+  def record(self, nbytes, seconds):
+    self.window_bytes += nbytes
+    self.latencies.append(seconds)
+    if len(self.latencies) >= self.window:
+      self.adjust()
+
+  def adjust(self):
+    rate = self.window_bytes / max(time.time() - self.window_start, 1e-6)
+    latency = sorted(self.latencies)[len(self.latencies) // 2]
+
+    low, high = self.target_latency
+    if latency < low:
+      self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+    elif latency > high:
+      self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+
+    # keep going the same way while throughput improves, turn around when it drops
+    if self.last_rate is not None and rate < self.last_rate * 0.95:
+      self.direction = -self.direction
+    self.concurrency = min(max(self.concurrency + self.direction, self.min_concurrency), self.max_concurrency)
+    self.last_rate = rate
+    self.emit(rate, latency)
+    self.reset_window()
+
+  def throttled(self):
+    self.concurrency = max(self.concurrency // 2, self.min_concurrency)
+    self.direction = -1
+    self.last_rate = None
+    self.emit(None, None)
+    self.reset_window()
+
+  def emit(self, rate, latency):
+    settings = {
+      "chunk_size": self.chunk_size,
+      "concurrency": self.concurrency,
+      "rate": rate,
+      "latency": latency
+    }
+    self.history.append(settings)
+    if rate is None:
+      print("adaptive: throttled, chunk_size=%d concurrency=%d" % (self.chunk_size, self.concurrency))
+    else:
+      print("adaptive: chunk_size=%d concurrency=%d (%.2f MB/s, median range %.2f s)" % (
+        self.chunk_size, self.concurrency, rate / 1e6, latency))
+
+  def settings(self):
+    return {"chunk_size": self.chunk_size, "concurrency": self.concurrency}
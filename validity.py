@@ -0,0 +1,64 @@
+import numpy as np
+
+
+def box_sum(data, size):
+    """
+    Sum of every size x size window, centered on each pixel, from one integral image.
+    Pixels whose window leaves the array are NaN.
+    """
+    half = size // 2
+    n_lin, n_pix = data.shape
+    out = np.full(data.shape, np.nan)
+    if n_lin < size or n_pix < size:
+        return out
+    s = np.zeros((n_lin + 1, n_pix + 1))
+    np.cumsum(data, axis=0, out=s[1:, 1:])
+    np.cumsum(s[1:, 1:], axis=1, out=s[1:, 1:])
+    out[half:n_lin - half, half:n_pix - half] = (s[size:, size:] - s[:-size, size:] -
+                                                 s[size:, :-size] + s[:-size, :-size])
+    return out
+
+
+class WindowStats:
+    """
+    Mean, std and coefficient of variation of the size x size window around every pixel,
+    the same numbers validate_matchup gets from rrs.std() / rrs.mean() on one window.
+    A window holding a NaN gets NaN statistics, like numpy does.
+    """
+
+    def __init__(self, data, size=3):
+        if size % 2 != 1:
+            raise ValueError("window size must be odd, got %d" % size)
+        data = np.asarray(data, dtype=np.float64)
+        finite = np.isfinite(data)
+        # shifting by the scene mean keeps sum(x^2) - sum(x)^2 / n from cancelling out
+        shift = data[finite].mean() if finite.any() else 0.
+        values = np.where(finite, data - shift, 0.)
+        n = size * size
+        missing = box_sum((~finite).astype(np.float64), size)
+        total = box_sum(values, size)
+        squares = box_sum(values * values, size)
+        self.size = size
+        self.mean = total / n + shift
+        self.std = np.sqrt(np.maximum(squares / n - (total / n) ** 2, 0.))
+        self.mean[missing > 0] = np.nan
+        self.std[missing > 0] = np.nan
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.cv = self.std / self.mean
+
+
+def validity_map(valid, rrs, size=3, min_valid=5, max_cv=0.15):
+    """
+    validate_matchup for every pixel at once: the center pixel is valid, at least
+    min_valid pixels of its window are valid and the window CV of rrs is not above
+    max_cv. Pixels whose window leaves the scene are never valid.
+
+    Returns the boolean map and the WindowStats of rrs.
+    """
+    valid = np.asarray(valid, dtype=bool)
+    n_valid = box_sum(valid.astype(np.float64), size)
+    stats = WindowStats(rrs, size)
+    with np.errstate(invalid='ignore'):
+        # a NaN CV never fails the test, as in validate_matchup
+        matchup = valid & (n_valid >= min_valid) & ~(stats.cv > max_cv)
+    return matchup, stats